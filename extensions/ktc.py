@@ -6,7 +6,7 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 #
 from __future__ import annotations
-import typing
+import typing, contextlib, collections, time
 # import cProfile, pstats, io
 
 # from .ktc_base import * # pylint: disable=relative-beyond-top-level, wildcard-import
@@ -15,7 +15,17 @@ from .ktc_base import (
     KtcBaseClass,
     KtcBaseToolClass,
 )
-from .ktc_heater import HeaterStateType
+from .ktc_heater import (
+    HeaterStateType,
+    KtcHeaterScheduler,
+    KtcHeaterPowerBudget,
+    KtcPredictivePreheat,
+    KtcSettlingWindow,
+    DEFAULT_PREDICTIVE_PREHEAT_HEATUP_TIME,
+    PREDICTIVE_PREHEAT_MARGIN,
+    PREDICTIVE_PREHEAT_MIN_PROBABILITY,
+)
+from .ktc_tree import KtcToolTree
 
 # Only import these modules in Dev environment. Consult Dev_doc.md for more info.
 if typing.TYPE_CHECKING:
@@ -25,7 +35,8 @@ if typing.TYPE_CHECKING:
         # gcode_move as klippy_gcode_move,
         fan_generic as klippy_fan_generic,
     )
-    from . import ktc_log, ktc_persisting, ktc_toolchanger, ktc_tool, ktc_heater
+    from . import (ktc_log, ktc_persisting, ktc_toolchanger, ktc_tool, ktc_heater,
+                   ktc_tool_group)
 
 # Constants for the restore_axis_on_toolchange variable.
 XYZ_TO_INDEX: dict[str, int] = {"x": 0, "X": 0, "y": 1, "Y": 1, "z": 2, "Z": 2}
@@ -33,6 +44,16 @@ INDEX_TO_XYZ: dict[int, str] = {0: "X", 1: "Y", 2: "Z"}
 DEFAULT_WAIT_FOR_TEMPERATURE_TOLERANCE = 1  # Default tolerance in degC.
 # Don't wait for temperatures below this because they might be ambient.
 LOWEST_ALLOWED_TEMPERATURE_TO_WAIT_FOR = 40
+# Commands replaced by the native_mcodes option.
+NATIVE_MCODES = ("M104", "M106", "M107", "M109")
+# Commands replaced by the native_rrf_commands option.
+NATIVE_RRF_COMMANDS = ("G10", "M568", "M116")
+# Seconds between checks of the temperatures while waiting.
+TEMPERATURE_WAIT_POLL_INTERVAL = 0.25
+# Seconds between temperature reports while waiting, as the M109 wait.
+TEMPERATURE_WAIT_REPORT_INTERVAL = 1.
+# Longest window in seconds for a heater to be predicted to stay in tolerance.
+MAX_TEMPERATURE_SETTLE_TIME = 60.
 _OFFSET_HELP = (
     "\n[X: X position] or [X_ADJUST: X adjust]\n"
     + "[Y: Y position] or [Y_ADJUST: Y adjust]\n"
@@ -40,6 +61,11 @@ _OFFSET_HELP = (
 )
 
 _TOOL_HELP = "\n [TOOL: Tool name] or [T: Tool number]"
+_TOOL_GROUP_HELP = (
+    "\n or [TOOLS: Comma separated tool names or numbers]"
+    + " or [TOOLCHANGER: Toolchanger name] or [GROUP: ktc_tool_group name]"
+    + " or [ALL=1: All tools]"
+)
 
 
 class Ktc(KtcBaseClass, KtcConstantsClass):
@@ -53,6 +79,39 @@ class Ktc(KtcBaseClass, KtcConstantsClass):
         #: If True, will run with cProfile and log the stats to ktc.log.
         self.debug_with_profile = typing.cast(
             bool, config.getboolean("debug_with_profile", False))  # type: ignore
+        #: If True, toolchanges while printing are deferred until the next
+        #: extruding move so back to back toolchanges collapse to the last one.
+        self.elide_redundant_toolchanges = typing.cast(
+            bool, config.getboolean("elide_redundant_toolchanges", False))  # type: ignore
+        # Tool requested by KTC_T# but not yet selected.
+        self.pending_tool: typing.Optional["ktc_tool.KtcTool"] = None
+        # Replace the M104, M106, M107 and M109 macros with native handlers.
+        self.native_mcodes = typing.cast(
+            bool, config.getboolean("native_mcodes", False))  # type: ignore
+        # Replace the RepRapFirmware G10, M568 and M116 macros with native handlers.
+        self.native_rrf_commands = typing.cast(
+            bool, config.getboolean("native_rrf_commands", False))  # type: ignore
+        # Register T<index> commands for tools that have no such command already.
+        self.register_tool_commands = typing.cast(
+            bool, config.getboolean("register_tool_commands", False))  # type: ignore
+        # Handlers replaced by native commands, by command name.
+        self._replaced_commands: dict[str, typing.Callable] = {}
+        self.defer_temperature_wait = typing.cast(
+            bool, config.getboolean("defer_temperature_wait", False))  # type: ignore
+        # Tolerance and settle time of temperature waits deferred until
+        # extrusion, by heater name.
+        self.pending_temperature_wait: dict[str, tuple[float, float]] = {}
+        self.predictive_preheat = typing.cast(
+            bool, config.getboolean("predictive_preheat", False))  # type: ignore
+        # Number of most recently selected tools kept at standby temperature
+        # without powering down. 0 disables the warm pool.
+        self.warm_pool_size = typing.cast(
+            int, config.getint("warm_pool_size", 0, minval=0))  # type: ignore
+        # Tools in the warm pool, least recently selected first.
+        self.warm_pool: collections.OrderedDict[
+            "ktc_tool.KtcTool", None] = collections.OrderedDict()
+        # Preheat of the tool predicted to be selected next.
+        self._preheat: typing.Optional[KtcPredictivePreheat] = None
 
         ############################
         # Load the persistent variables object
@@ -68,11 +127,28 @@ class Ktc(KtcBaseClass, KtcConstantsClass):
         self.all_tools: dict[str, "ktc_tool.KtcTool"] = {}
         self.all_tools_by_number: dict[int, "ktc_tool.KtcTool"] = {}
         self._registered_toolnumbers: list[int] = []
+        # Tool numbers having a T<index> command registered by KTC.
+        self._registered_t_toolnumbers: list[int] = []
         self.all_toolchangers: dict[str, "ktc_toolchanger.KtcToolchanger"] = {}
+        self.tool_groups: dict[str, "ktc_tool_group.KtcToolGroup"] = {}
         self._tools_having_tc: typing.Dict[
             "ktc_tool.KtcTool", "ktc_toolchanger.KtcToolchanger"
         ] = {}
         self.all_heaters: dict[str, "ktc_heater.KtcHeater"] = {}
+        # Heater targets set while heater_batch_depth > 0 are applied once
+        # when the outermost batch ends.
+        self.heater_batch_depth = 0
+        self.heaters_pending_temp: dict["ktc_heater.KtcHeater", None] = {}
+        # Number of klippy heater set_temp calls skipped as redundant.
+        self.heater_set_temp_suppressed = 0
+        # One reactor timer dispatching the standby and powerdown timers of all heaters.
+        self.heater_scheduler = KtcHeaterScheduler(self.printer)
+        # Limit in watts for the power of heaters heating up at the same time.
+        self.heater_power_budget = KtcHeaterPowerBudget(
+            self.printer, typing.cast(float, config.getfloat(
+                "heater_power_budget", 0., minval=0.)))  # type: ignore
+        # Index of the tool tree. Built when all tools are configured.
+        self.tool_tree: KtcToolTree = None  # type: ignore
 
         self.__active_tool = self.TOOL_UNKNOWN  # The currently active tool.
 
@@ -119,6 +195,23 @@ class Ktc(KtcBaseClass, KtcConstantsClass):
             if tool.state < tool.StateType.CONFIGURED:
                 raise ValueError("Tool %s did not configure properly." % tool.name)
 
+        for group in dict(self.printer.lookup_objects("ktc_tool_group")).values():
+            group.configure_tools(self.all_tools)
+            self.tool_groups[group.name.lower()] = group
+
+        # All heaters are loaded by the tools now.
+        self.heater_power_budget.configure_heaters(self.all_heaters.values())
+
+        # Native commands can't be combined with the macros they replace.
+        if self.native_mcodes:
+            self._check_no_macros_for_native_commands(NATIVE_MCODES, "native_mcodes")
+        if self.native_rrf_commands:
+            self._check_no_macros_for_native_commands(
+                NATIVE_RRF_COMMANDS, "native_rrf_commands")
+
+        # The tree does not change after this point so index it once.
+        self.tool_tree = KtcToolTree(self.default_toolchanger, self._tools_having_tc)
+
         # Register commands
         handlers = [
             "KTC_DESELECT_ALL",
@@ -140,6 +233,9 @@ class Ktc(KtcBaseClass, KtcConstantsClass):
             "KTC_TOOL_MAP_NR",
             "KTC_DEBUG_HEATERS",
             "KTC_DEBUG_TOOLS",
+            "KTC_PLAN_TOOLCHANGE",
+            "KTC_TOOLCHANGE_FLUSH",
+            "KTC_DEBUG_BENCHMARK",
         ]
         for cmd in handlers:
             func = getattr(self, "cmd_" + cmd)
@@ -154,6 +250,12 @@ class Ktc(KtcBaseClass, KtcConstantsClass):
             self.default_toolchanger.__class__.InitModeType.ON_START,
         )
         self._register_tool_gcode_commands()
+        if self.elide_redundant_toolchanges or self.defer_temperature_wait:
+            self._wrap_move_commands()
+        if self.native_mcodes:
+            self._register_native_commands(NATIVE_MCODES)
+        if self.native_rrf_commands:
+            self._register_native_commands(NATIVE_RRF_COMMANDS)
 
     def _config_default_toolchanger(self):
         """Set the default toolchanger and validate it."""
@@ -276,16 +378,51 @@ class Ktc(KtcBaseClass, KtcConstantsClass):
                     self._registered_toolnumbers.append(tool.number)
                     self.gcode.register_command(
                         "KTC_T" + str(tool.number),
-                        tool.select,
+                        self._select_tool_number_func(tool.number),
                         False,
-                        "Select tool " + tool.name + " with number " + str(tool.number),
+                        "Select the tool with number " + str(tool.number),
                     )
+                if (self.register_tool_commands
+                        and tool.number not in self._registered_t_toolnumbers
+                        and self._register_tool_command(tool)):
+                    self._registered_t_toolnumbers.append(tool.number)
         # Get all toolnumbers from self._registered_toolnumbers that are not in new_toolnumbers.
         # This removes all tools that have been removed since reading the config file.
-        for toolnumber in (
+        for toolnumber in [
             x for x in self._registered_toolnumbers if x not in new_toolnumbers
-        ):
+        ]:
             self.gcode.register_command("KTC_T" + str(toolnumber), None)
+            self._registered_toolnumbers.remove(toolnumber)
+        for toolnumber in [
+            x for x in self._registered_t_toolnumbers if x not in new_toolnumbers
+        ]:
+            self.gcode.register_command("T" + str(toolnumber), None)
+            self._registered_t_toolnumbers.remove(toolnumber)
+
+    def _select_tool_number_func(self, number: int) -> typing.Callable:
+        """Return a command handler selecting the tool having the number when
+        run, so it follows remapping by KTC_TOOL_MAP_NR."""
+        def func(gcmd):
+            tool = self.all_tools_by_number.get(number)
+            if tool is None:
+                raise gcmd.error("T%d not found" % (number))
+            tool.cmd_SelectTool(gcmd)
+        return func
+
+    def _register_tool_command(self, tool: "ktc_tool.KtcTool") -> bool:
+        """Register T<index> for the tool, unless a macro or other command is
+        already registered with that name. Returns True if registered."""
+        cmd = "T" + str(tool.number)
+        prev_func = self.gcode.register_command(cmd, None)
+        if prev_func is not None:
+            self.gcode.register_command(
+                cmd, prev_func, desc=self.gcode.gcode_help.get(cmd))
+            self.log.trace(f"{cmd} already registered, using it instead of KTC_{cmd}.")
+            return False
+        self.gcode.register_command(
+            cmd, self._select_tool_number_func(tool.number), False,
+            "Select the tool with number " + str(tool.number))
+        return True
 
     def _recursive_configure_inherited_attributes(
         self, tc: "ktc_toolchanger.KtcToolchanger"
@@ -508,6 +645,11 @@ class Ktc(KtcBaseClass, KtcConstantsClass):
         self.run_with_profile(self.deselect_all_tools)
 
     def deselect_all_tools(self):
+        # A toolchange that never extruded is not needed anymore.
+        self.discard_pending_toolchange()
+        self.cancel_predictive_preheat()
+        self.pending_temperature_wait = {}
+
         if self.active_tool == self.TOOL_UNKNOWN:
             raise self.printer.command_error(
                 "Unknown tool is active and can't be deselected."
@@ -540,7 +682,8 @@ class Ktc(KtcBaseClass, KtcConstantsClass):
             raise Exception("Failed to deselect all tools: %s" % str(e)) from e
 
     cmd_KTC_SET_AND_SAVE_PARTFAN_SPEED_help = (
-        "[TOOL=<name> | T=<index>] [S=<value>]\n"
+        "[TOOL=<name> | T=<index> | TOOLS=<names> | TOOLCHANGER=<name> | "
+        + "GROUP=<name> | ALL=1] [S=<value>]\n"
         + "Save the fan speed to be recovered at ToolChange."
     )
 
@@ -548,9 +691,10 @@ class Ktc(KtcBaseClass, KtcConstantsClass):
         self, gcmd: "gcode.GCodeCommand"
     ):  # pylint: disable=invalid-name
         try:
-            tool = self.get_tool_from_gcmd(gcmd)
+            tools = self.get_tools_from_gcmd(gcmd)
             fanspeed = typing.cast(float, gcmd.get_float("S", 1.0, 0.0, 255.0))
-            self.set_and_save_fan_speed(tool, fanspeed)
+            for tool in tools:
+                self.set_and_save_fan_speed(tool, fanspeed)
         except Exception as e:
             raise gcmd.error(
                 f"Failed to set and save fan speed with command {gcmd.get_commandline()}: {str(e)}"
@@ -567,11 +711,150 @@ class Ktc(KtcBaseClass, KtcConstantsClass):
         self.saved_fan_speed = fanspeed
         self.tool_fan_speed_set(tool, fanspeed)
 
+    def _check_no_macros_for_native_commands(self, cmds: tuple[str, ...], option: str):
+        """Raise a config error if any of the commands is a gcode_macro. The
+        native handler would otherwise replace the macro, or the macro's
+        rename_existing fail, depending on the order of the connect handlers."""
+        macros = [cmd for cmd in cmds
+                  if self.printer.lookup_object("gcode_macro " + cmd, None) is not None]
+        if macros:
+            raise self.config.error(
+                f"{option} in [ktc] replaces the macros "
+                + ", ".join(f"[gcode_macro {cmd}]" for cmd in macros)
+                + f". Remove the macros from the config or disable {option}.")
+
+    def _register_native_commands(self, cmds: tuple[str, ...]):
+        """Register the native handlers of the commands. The replaced command is
+        kept as M104.1 and so on, like rename_existing in the KTC macros.
+        If the stock command was already renamed, it is kept."""
+        for cmd in cmds:
+            prev_func = self.gcode.register_command(cmd, None)
+            if prev_func is not None:
+                renamed = cmd + ".1"
+                renamed_func = self.gcode.register_command(renamed, None)
+                self.gcode.register_command(
+                    renamed, renamed_func or prev_func,
+                    desc=self.gcode.gcode_help.get(renamed, self.gcode.gcode_help.get(cmd)))
+                self._replaced_commands[cmd] = renamed_func or prev_func
+            self.gcode.register_command(
+                cmd, getattr(self, "cmd_" + cmd), False,
+                getattr(self, "cmd_" + cmd + "_help"))
+
+    def _get_tool_from_mcode(
+        self, gcmd: "gcode.GCodeCommand", explicit: bool = False
+    ) -> "ktc_tool.KtcTool":
+        """Return the tool numbered by P, or by T if P is not given, like
+        get_tool_from_gcmd."""
+        tool_nr = gcmd.get_int("P", None)
+        if tool_nr is None:
+            return self.get_tool_from_gcmd(gcmd, explicit=explicit)
+        if tool_nr not in self.all_tools_by_number:
+            raise gcmd.error("T%d not found" % (tool_nr))
+        return self.all_tools_by_number[tool_nr]
+
+    cmd_M104_help = ("[T<index> | P<index>] [S<temperature>]\n"
+                     + "Set the active temperature of the tool.")
+    def cmd_M104(self, gcmd):  # pylint: disable=invalid-name
+        tool = self._get_tool_from_mcode(gcmd)
+        temp = gcmd.get_float("S", None, minval=0.)
+        if temp is not None:
+            tool.set_heaters(heater_active_temp=temp)
+
+    cmd_M109_help = ("[T<index> | P<index> | H<heater>] [S<temperature>] [W<tolerance>]\n"
+                     + "Set the active temperature of the tool if specified, "
+                     + "and wait for the temperatures.")
+    def cmd_M109(self, gcmd):  # pylint: disable=invalid-name
+        self._set_temperature_and_wait(gcmd)
+
+    cmd_M106_help = ("[T<index> | P<index>] [S<value>]\n"
+                     + "Set and save the fan speed of the tool, 0-1 or 2-255.")
+    def cmd_M106(self, gcmd):  # pylint: disable=invalid-name
+        tool = self._get_tool_from_mcode(gcmd)
+        self.set_and_save_fan_speed(
+            tool, typing.cast(float, gcmd.get_float("S", 1.0, 0.0, 255.0)))
+
+    cmd_M107_help = "[T<index> | P<index>]\nTurn off the fan of the tool."
+    def cmd_M107(self, gcmd):  # pylint: disable=invalid-name
+        self.set_and_save_fan_speed(self._get_tool_from_mcode(gcmd), 0.)
+
+    def _set_temperature_and_wait(self, gcmd: "gcode.GCodeCommand"):
+        """Set the active temperature of the tool if specified by M109 or M116,
+        and wait for the temperatures."""
+        tool = self._get_tool_from_mcode(gcmd, explicit=True)
+        var_heater = typing.cast(str, gcmd.get("H", None))
+        temp = gcmd.get_float("S", None, minval=0.)
+        tolerance = gcmd.get_float(
+            "W", DEFAULT_WAIT_FOR_TEMPERATURE_TOLERANCE, minval=0., maxval=9.)
+        # As the M109 macro, S is only set when a tool is specified.
+        if temp is not None and tool is not None:
+            tool.set_heaters(heater_active_temp=temp,
+                             heater_state=HeaterStateType.ACTIVE)
+        if var_heater:
+            tool = None
+        heater_names = self._get_heater_names_to_wait_for(gcmd, tool, var_heater)
+        # Waits immediately as the M109 and M116 macros,
+        # only KTC_TEMPERATURE_WAIT_WITH_TOLERANCE is deferred.
+        self.temperature_wait(heater_names, tolerance, 0., False)
+
+    cmd_G10_help = ("[P<index>] [R<temperature>] [S<temperature>]\n"
+                    + "Set tool temperatures as M568. Without tool temperature "
+                    + "parameters, runs the replaced G10.")
+    def cmd_G10(self, gcmd):  # pylint: disable=invalid-name
+        params = gcmd.get_command_parameters()
+        prev_func = self._replaced_commands.get("G10")
+        # G10 is also firmware retraction and G10 L2/L20 sets workplace offsets.
+        if prev_func is not None and (
+                "L" in params or not any(p in params for p in "PTRSANO")):
+            prev_func(gcmd)
+            return
+        self.cmd_M568(gcmd)
+
+    cmd_M568_help = ("[T<index> | P<index>] [S<temperature>] [R<temperature>] "
+                     + "[A<state>] [N<seconds>] [O<seconds>]\n"
+                     + "Set tool temperatures as KTC_TOOL_SET_TEMPERATURE.")
+    def cmd_M568(self, gcmd):  # pylint: disable=invalid-name
+        tool = self._get_tool_from_mcode(gcmd)
+        actv_tmp = gcmd.get_float("S", None, minval=0.)
+        stdb_tmp = gcmd.get_float("R", None, minval=0.)
+        chng_state = gcmd.get("A", None)
+        stdb_timeout = gcmd.get_float("N", None, minval=0.)
+        shtdwn_timeout = gcmd.get_float("O", None, minval=0.)
+
+        if len(tool.extruder.heaters) < 1:
+            self.log.always(f"T{tool.name} has no heaters! Nothing to do.")
+            return
+
+        set_heater_cmd = {}
+        if stdb_tmp is not None:
+            set_heater_cmd["heater_standby_temp"] = int(stdb_tmp)
+        if actv_tmp is not None:
+            set_heater_cmd["heater_active_temp"] = int(actv_tmp)
+        if stdb_timeout is not None:
+            set_heater_cmd["heater_active_to_standby_delay"] = max(stdb_timeout, 0.1)
+        if shtdwn_timeout is not None:
+            set_heater_cmd["heater_standby_to_powerdown_delay"] = max(shtdwn_timeout, 0.1)
+        try:
+            if chng_state is not None:
+                set_heater_cmd["heater_state"] = HeaterStateType.parse_heater_state(
+                    chng_state)
+        except ValueError as e:
+            raise gcmd.error("M568: Error: %s" % str(e)) from e
+        if set_heater_cmd:
+            tool.set_heaters(**set_heater_cmd)
+
+    cmd_M116_help = ("[T<index> | P<index> | H<heater>] [S<temperature>] [W<tolerance>]\n"
+                     + "Wait for the temperatures as M109.")
+    def cmd_M116(self, gcmd):  # pylint: disable=invalid-name
+        self._set_temperature_and_wait(gcmd)
+
     cmd_KTC_TEMPERATURE_WAIT_WITH_TOLERANCE_help = (
-        "[TOOL=<name> | T=<index>] [TOLERANCE=<0-9>]\n"
+        "[TOOL=<name> | T=<index>] [TOLERANCE=<0-9>] [SETTLE=<seconds>] [DEFER=<0|1>]\n"
         + "Waits for current tool temperature, or a specified.\n"
         + "TOOL= Tool name or T= Tool number or HEATER= Coma separated list of heater names.\n"
-        + "TOLERANCE= Tolerance in degC. Defaults to 1*C."
+        + "TOLERANCE= Tolerance in degC, can be fractional. Defaults to 1*C.\n"
+        + "SETTLE= Seconds the temperature is predicted to stay within tolerance.\n"
+        + "DEFER= While printing, wait at the first extruding move instead. "
+        + "Defaults to defer_temperature_wait."
     )
 
     def cmd_KTC_TEMPERATURE_WAIT_WITH_TOLERANCE(
@@ -585,12 +868,17 @@ class Ktc(KtcBaseClass, KtcConstantsClass):
         TOOL= Tool name.
         T= Tool number.
         HEATER= Coma separated list of heater names.
-        TOLERANCE=nnn Tolerance in degC. Defaults to 1*C.
+        TOLERANCE=nnn Tolerance in degC, can be fractional. Defaults to 1*C.
+        SETTLE=nnn Only stop waiting when the temperature is also predicted to
+            stay within tolerance for this many seconds. Defaults to 0.
+        DEFER=0|1 While printing, wait at the first extruding move instead.
         Wait will wait until heater is between set temperature +/- tolerance."""
-        heater_names = []
-        tolerance = gcmd.get_int(
-            "TOLERANCE", DEFAULT_WAIT_FOR_TEMPERATURE_TOLERANCE, minval=0, maxval=9
+        tolerance = gcmd.get_float(
+            "TOLERANCE", DEFAULT_WAIT_FOR_TEMPERATURE_TOLERANCE, minval=0., maxval=9.
         )
+        settle = gcmd.get_float("SETTLE", 0., minval=0., maxval=MAX_TEMPERATURE_SETTLE_TIME)
+        defer = gcmd.get_int(
+            "DEFER", int(self.defer_temperature_wait), minval=0, maxval=1)
         var_heater = typing.cast(str, gcmd.get("HEATER", None))
         tool = self.get_tool_from_gcmd(gcmd, explicit=True)
 
@@ -599,6 +887,19 @@ class Ktc(KtcBaseClass, KtcConstantsClass):
                 "Can't use both TOOL and HEATER parameter at the same time."
             )
 
+        heater_names = self._get_heater_names_to_wait_for(gcmd, tool, var_heater)
+        self.log.trace(
+            f"cmd_KTC_TEMPERATURE_WAIT_WITH_TOLERANCE: Heater names: {heater_names}."
+        )
+        self.temperature_wait(heater_names, tolerance, settle, bool(defer))
+
+    def _get_heater_names_to_wait_for(
+        self, gcmd: "gcode.GCodeCommand",
+        tool: typing.Optional["ktc_tool.KtcTool"], var_heater: typing.Optional[str]
+    ) -> list[str]:
+        """Return the heaters named in var_heater, or else the heaters of the tool
+        or of the active tool and the bed."""
+        heater_names = []
         available_heaters = typing.cast(
             "klippy_heaters.PrinterHeaters", self.printer.lookup_object("heaters")
         ).available_heaters
@@ -626,39 +927,127 @@ class Ktc(KtcBaseClass, KtcConstantsClass):
             if not tool:
                 tool = self.get_tool_from_gcmd(gcmd)
             heater_names += [tool_heater.name for tool_heater in tool.extruder.heaters]
+        return heater_names
+
+    def temperature_wait(self, heater_names: list[str], tolerance: float,
+                         settle: float, defer: bool):
+        """Wait for the heaters now, or at the first extruding move if defer is set,
+        defer_temperature_wait is enabled and a print is running."""
+        if defer and self.defer_temperature_wait and self._is_printing():
+            # Added to earlier deferred waits, a new wait for the same heater
+            # replaces its earlier one.
+            for name in heater_names:
+                self.pending_temperature_wait[name] = (tolerance, settle)
+            self.log.trace(f"Temperature wait for {heater_names} deferred until extrusion.")
+            return
+        self.wait_for_heaters(heater_names, tolerance, settle)
 
-        self.log.trace(
-            f"cmd_KTC_TEMPERATURE_WAIT_WITH_TOLERANCE: Heater names: {heater_names}."
-        )
+    def discard_pending_temperature_wait(self, heater_names: list[str]):
+        """Drop the deferred waits for the heaters, called when their tool is
+        deselected and the wait is not needed anymore."""
+        for name in heater_names:
+            self.pending_temperature_wait.pop(name, None)
+
+    def enforce_pending_temperature_wait(self):
+        """Run the deferred temperature waits, if any. Heaters with the same
+        tolerance and settle time are waited for together."""
+        waits: dict[tuple[float, float], list[str]] = {}
+        for name, tolerance_and_settle in self.pending_temperature_wait.items():
+            waits.setdefault(tolerance_and_settle, []).append(name)
+        self.pending_temperature_wait = {}
+        for (tolerance, settle), heater_names in waits.items():
+            self.wait_for_heaters(heater_names, tolerance, settle)
+
+    def wait_for_heaters(self, heater_names: list[str], tolerance: float,
+                         settle: float = 0.):
+        """Wait until all heaters are within tolerance of their target temperature.
+        With settle, also wait until the temperature trend over the last settle
+        seconds keeps it within tolerance settle seconds ahead.
+        All heaters are polled in the same loop so the wait is as long as the
+        slowest heater. Heaters with a target below
+        LOWEST_ALLOWED_TEMPERATURE_TO_WAIT_FOR are not waited for.
+        The time the classic wait, with integer target and tolerance, would
+        have taken is reported for comparison."""
+        reactor = self.printer.get_reactor()
+        toolhead = self.printer.lookup_object("toolhead")
+        pheaters = typing.cast(
+            "klippy_heaters.PrinterHeaters", self.printer.lookup_object("heaters"))
+        if self.printer.get_start_args().get("debugoutput") is not None:
+            return
 
+        # Wait for all queued moves to be sent before starting the wait.
+        toolhead.get_last_move_time()
+        start_time = eventtime = reactor.monotonic()
+        waiting: dict[str, "klippy_heaters.Heater"] = {}
+        # A target queued by the power budget is waited for as if set.
+        queued_temp = self.heater_power_budget.queued_temp
+        # Heaters are named by the last word of the config name, so
+        # "heater_generic chamber" is "chamber".
+        heater_names = [name.split()[-1] for name in heater_names]
         for name in heater_names:
-            self._temperature_wait_with_tolerance(name, tolerance)
+            heater = pheaters.lookup_heater(name)
+            target_temp = queued_temp(name)
+            if target_temp is None:
+                target_temp = heater.get_temp(eventtime)[1]
+            if target_temp > LOWEST_ALLOWED_TEMPERATURE_TO_WAIT_FOR:
+                waiting[name] = heater
+                self.log.always(
+                    f"Waiting for heater {name} to reach {target_temp:.1f}"
+                    + f" with a tolerance of {tolerance}"
+                    + (f", settled for {settle}s." if settle else ".")
+                )
+        if not waiting:
+            return
 
-    def _temperature_wait_with_tolerance(
-        self, heater_name, tolerance
-    ):  # pylint: disable=invalid-name
-        curtime = self.printer.get_reactor().monotonic()
-        target_temp = int(
-            self.printer.lookup_object(heater_name).get_status(curtime)["target"]
-        )
+        waited_for = dict(waiting)
+        windows = {name: KtcSettlingWindow(settle) for name in waiting}
+        ready_after: dict[str, float] = {}
+        classic_after: dict[str, float] = {}
+        last_report = None
+        while not self.printer.is_shutdown():
+            # Report the temperatures of the heaters waited for like the M109 wait does.
+            if last_report is None or eventtime - last_report >= TEMPERATURE_WAIT_REPORT_INTERVAL:
+                last_report = eventtime
+                self.gcode.respond_raw(" ".join(
+                    "%s:%.1f /%.1f" % ((name,) + heater.get_temp(eventtime))
+                    for name, heater in waited_for.items()))
+            for name, heater in list(waiting.items()):
+                temp, target = heater.get_temp(eventtime)
+                if queued_temp(name) is not None:
+                    continue
+                if (name not in classic_after
+                    and abs(temp - int(target)) <= int(tolerance)):
+                    classic_after[name] = eventtime - start_time
+                if settle:
+                    windows[name].add(eventtime, temp)
+                    ready = windows[name].is_settled(target, tolerance)
+                else:
+                    ready = abs(temp - target) <= tolerance
+                if ready:
+                    ready_after[name] = eventtime - start_time
+                    del waiting[name]
+                    if name in self.all_heaters:
+                        self.all_heaters[name].last_wait_time = ready_after[name]
+            if not waiting:
+                break
+            toolhead.get_last_move_time()
+            eventtime = reactor.pause(eventtime + TEMPERATURE_WAIT_POLL_INTERVAL)
+        if waiting:
+            return
 
-        if target_temp > LOWEST_ALLOWED_TEMPERATURE_TO_WAIT_FOR:
-            self.log.always(
-                f"Waiting for heater {heater_name} to reach {target_temp}"
-                + f" with a tolerance of {tolerance}."
-            )
-            self.gcode.run_script_from_command(
-                "TEMPERATURE_WAIT SENSOR="
-                + heater_name
-                + " MINIMUM="
-                + str(target_temp - tolerance)
-                + " MAXIMUM="
-                + str(target_temp + tolerance)
-            )
-            self.log.always("Wait for heater " + heater_name + " complete.")
+        self.log.always(
+            "Wait for heaters complete in %.1fs: " % (eventtime - start_time)
+            + ", ".join(
+                "%s %.1fs (classic %s)" % (
+                    name, t, "%.1fs" % classic_after[name]
+                    if name in classic_after else "not reached")
+                for name, t in ready_after.items())
+            + "."
+        )
 
     cmd_KTC_TOOL_SET_TEMPERATURE_help = (
-        "[TOOL=<name> | T=<index>] [ACTV_TMP=<temperature>] [STDB_TMP=<temperature>]"
+        "[TOOL=<name> | T=<index> | TOOLS=<names> | TOOLCHANGER=<name> | "
+        + "GROUP=<name> | ALL=1] [ACTV_TMP=<temperature>] [STDB_TMP=<temperature>]"
         + "[CHNG_STATE=<0|1|2>|<OFF|STANDBY|ACTIVE>] [STDB_TIMEOUT=<seconds>]"
         + "[SHTDWN_TIMEOUT=<seconds>]\n"
         + "Waits for all temperatures, or a specified (TOOL) tool or"
@@ -674,6 +1063,7 @@ class Ktc(KtcBaseClass, KtcConstantsClass):
         [SHTDWN_TIMEOUT=<seconds>]
         Set tool temperature.
         TOOL= Tool number, optional. If this parameter is not provided, the current tool is used.
+        TOOLS=, TOOLCHANGER=, GROUP= or ALL=1 apply the settings to a group of tools.
         STDB_TMP= Standby temperature(s), optional
         ACTV_TMP= Active temperature(s), optional
         CHNG_STATE = Change Heater State, optional:
@@ -689,7 +1079,7 @@ class Ktc(KtcBaseClass, KtcConstantsClass):
             Use for example 86400 to wait 24h if you want to disable shutdown timer.
         """
         try:
-            tool = self.get_tool_from_gcmd(gcmd)
+            tools = self.get_tools_from_gcmd(gcmd)
 
             stdb_tmp = gcmd.get_int("STDB_TMP", None, minval=0)
             actv_tmp = gcmd.get_int("ACTV_TMP", None, minval=0)
@@ -698,15 +1088,12 @@ class Ktc(KtcBaseClass, KtcConstantsClass):
             shtdwn_timeout = gcmd.get_float("SHTDWN_TIMEOUT", None, minval=0)
 
             self.log.trace(
-                f"cmd_KTC_TOOL_SET_TEMPERATURE: T{tool.name}: stdb_tmp:{stdb_tmp}, "
+                f"cmd_KTC_TOOL_SET_TEMPERATURE: {[tool.name for tool in tools]}: "
+                + f"stdb_tmp:{stdb_tmp}, "
                 + f"actv_tmp:{actv_tmp}, chng_state:{chng_state}, "
                 + f"stdb_timeout:{stdb_timeout}, shtdwn_timeout:{shtdwn_timeout}."
             )
 
-            if len(self.all_tools[tool.name].extruder.heaters) < 1:
-                self.log.always(f"T{tool.name} has no heaters! Nothing to do.")
-                return
-
             set_heater_cmd = {}
 
             if stdb_tmp is not None:
@@ -722,48 +1109,57 @@ class Ktc(KtcBaseClass, KtcConstantsClass):
                     chng_state
                 )
 
-            if len(set_heater_cmd) > 0:
-                tool.set_heaters(**set_heater_cmd)
-            else:
-                # Print out the current temperature settings.
-                ext = tool.extruder
-                msg = (
-                    f"{tool.name} is {ext.state}:\n"
-                    + f"Active temperature: {ext.active_temp}\n"
-                    + f"Standby temperature: {ext.standby_temp}\n"
-                    + f"Active to Standby timer: {ext.active_to_standby_delay} seconds\n"
-                    + f"Standby to Off timer: {ext.standby_to_powerdown_delay} seconds\n"
-                )
-
-                if ext.state == HeaterStateType.STANDBY:
-                    first_heater_object = self.all_heaters[ext.heaters[0].name]
-                    to_standby_timer = (
-                        first_heater_object.timer_heater_active_to_standby_delay
-                    )
-                    to_standby_timer_wake = to_standby_timer.get_status()["next_wake"]
-                    if to_standby_timer_wake:
-                        msg += (
-                            "\n Will go to standby temperature in "
-                            + f"{to_standby_timer_wake} seconds."
-                        )
-
-                    to_powerdown_timer = (
-                        first_heater_object.timer_heater_standby_to_powerdown_delay
-                    )
-                    to_powerdown_timer_wake = to_powerdown_timer.get_status()[
-                        "next_wake"
-                    ]
-                    if to_powerdown_timer_wake:
-                        msg += (
-                            "\n Will power down in "
-                            + f"{to_powerdown_timer_wake} seconds."
-                        )
-                gcmd.respond_info(msg)
+            # Heaters shared by tools in the group get their last target once.
+            with self.heater_batch():
+                for tool in tools:
+                    if len(tool.extruder.heaters) < 1:
+                        self.log.always(f"T{tool.name} has no heaters! Nothing to do.")
+                        continue
+                    if len(set_heater_cmd) > 0:
+                        tool.set_heaters(**set_heater_cmd)
+                    else:
+                        gcmd.respond_info(self._tool_temperature_info(tool))
         except ValueError as e:
             raise gcmd.error(
                 "KTC_TOOL_SET_TEMPERATURE: Error: %s" % str(e)
             ) from e.with_traceback(e.__traceback__)
 
+    def _tool_temperature_info(self, tool: "ktc_tool.KtcTool") -> str:
+        """Return the current temperature settings of the tool."""
+        ext = tool.extruder
+        msg = (
+            f"{tool.name} is {ext.state}:\n"
+            + f"Active temperature: {ext.active_temp}\n"
+            + f"Standby temperature: {ext.standby_temp}\n"
+            + f"Active to Standby timer: {ext.active_to_standby_delay} seconds\n"
+            + f"Standby to Off timer: {ext.standby_to_powerdown_delay} seconds\n"
+        )
+
+        if ext.state == HeaterStateType.STANDBY:
+            first_heater_object = self.all_heaters[ext.heaters[0].name]
+            to_standby_timer = (
+                first_heater_object.timer_heater_active_to_standby_delay
+            )
+            to_standby_timer_wake = to_standby_timer.get_status()["next_wake"]
+            if to_standby_timer_wake:
+                msg += (
+                    "\n Will go to standby temperature in "
+                    + f"{to_standby_timer_wake} seconds."
+                )
+
+            to_powerdown_timer = (
+                first_heater_object.timer_heater_standby_to_powerdown_delay
+            )
+            to_powerdown_timer_wake = to_powerdown_timer.get_status()[
+                "next_wake"
+            ]
+            if to_powerdown_timer_wake:
+                msg += (
+                    "\n Will power down in "
+                    + f"{to_powerdown_timer_wake} seconds."
+                )
+        return msg
+
     cmd_KTC_HEATERS_PAUSE_help = (
         "Turns off all heaters and saves changes made to be resumed by "
         + "KTC_HEATERS_RESUME."
@@ -799,11 +1195,13 @@ class Ktc(KtcBaseClass, KtcConstantsClass):
 
     def resume_all_tool_heaters(self):
         try:
-            for (
-                heater_name,
-                state,
-            ) in self._heaters_paused.items():
-                self.all_heaters[heater_name].state = state
+            # Heat-ups are staged by the power budget when the batch ends.
+            with self.heater_batch():
+                for (
+                    heater_name,
+                    state,
+                ) in self._heaters_paused.items():
+                    self.all_heaters[heater_name].state = state
         except Exception as e:
             raise Exception(
                 f"Failing to resume all heaters: {str(e)}"
@@ -820,16 +1218,19 @@ class Ktc(KtcBaseClass, KtcConstantsClass):
         return offset
 
     cmd_KTC_TOOL_OFFSET_SAVE_help = (
-        "Set and save the tool offset." + _TOOL_HELP + _OFFSET_HELP
+        "Set and save the tool offset." + _TOOL_HELP + _TOOL_GROUP_HELP + _OFFSET_HELP
     )
 
     def cmd_KTC_TOOL_OFFSET_SAVE(
         self, gcmd: "gcode.GCodeCommand"
     ):  # pylint: disable=invalid-name
-        tool: 'ktc_tool.KtcTool' = self.get_tool_from_gcmd(gcmd)
-        tool.offset = self.offset_from_gcmd(gcmd, tool.offset)
-        tool.persistent_state_set("offset", tool.offset)
-        self.log.always(f"Tool {tool.name} offset set to: {tool.offset}")
+        tools = self.get_tools_from_gcmd(gcmd)
+        for tool in tools:
+            tool.offset = self.offset_from_gcmd(gcmd, tool.offset)
+            tool.persistent_state_set("offset", tool.offset, force_save=False)
+            self.log.always(f"Tool {tool.name} offset set to: {tool.offset}")
+        # Write the file once for the whole group.
+        self._ktc_persistent.force_save()
 
     cmd_KTC_GLOBAL_OFFSET_SAVE_help = "Set the global tool offset" + _OFFSET_HELP
 
@@ -891,26 +1292,78 @@ class Ktc(KtcBaseClass, KtcConstantsClass):
             self.all_tools_by_number.pop(tool.number, None)
             self.all_tools_by_number[set_tool] = tool
             tool.number = set_tool
+            # Register commands for the new number and remove unused ones.
+            self._register_tool_gcode_commands()
         except Exception as e:
             raise gcmd.error(
                 f"Erorr remapping tool with command {gcmd.get_commandline()}: {str(e)}"
             ) from e
 
+    # Status fields as name: getter(self). Read lazily by G-code templates.
+    _STATUS_FIELDS = {
+        "global_offset": lambda self: self.global_offset,
+        # Active tool name and number for GCode compatibility.
+        "active_tool": lambda self: self.active_tool.name,
+        "active_tool_n": lambda self: self.active_tool.number,
+        "saved_fan_speed": lambda self: self.saved_fan_speed,
+        "pending_tool": lambda self: (
+            self.pending_tool.name if self.pending_tool is not None else None),
+        "warm_pool": lambda self: [tool.name for tool in self.warm_pool],
+        "pending_temperature_wait": lambda self: (
+            list(self.pending_temperature_wait)
+            if self.pending_temperature_wait else None),
+        "predicted_tool": lambda self: (
+            self._preheat.tool.name if self._preheat is not None else None),
+        "state": lambda self: self.state,
+        "tools": lambda self: list(self.all_tools.keys()),
+        "toolchangers": lambda self: list(self.all_toolchangers.keys()),
+        "transition_matrix": lambda self: self.log.transition_matrix_status(),
+        "heater_timers": lambda self: self._heater_timers_status(),
+        "heater_scheduler": lambda self: self.heater_scheduler.get_status(),
+        "heater_set_temp_suppressed": lambda self: self.heater_set_temp_suppressed,
+        "heater_power": lambda self: self.heater_power_budget.get_status(),
+        "TOOL_NONE": lambda self: self.TOOL_NONE.name,
+        "TOOL_UNKNOWN": lambda self: self.TOOL_UNKNOWN.name,
+        "params_available": lambda self: str(self.params.keys()),
+    }
+
     def get_status(self, eventtime=None):  # pylint: disable=unused-argument
-        status = {
-            "global_offset": self.global_offset,
-            "active_tool": self.active_tool.name,  # Active tool name for GCode compatibility.
-            "active_tool_n": self.active_tool.number,  # Active tool number for GCode compatibility.
-            "saved_fan_speed": self.saved_fan_speed,
-            "state": self.state,
-            "tools": list(self.all_tools.keys()),
-            "toolchangers": list(self.all_toolchangers.keys()),
-            "TOOL_NONE": self.TOOL_NONE.name,
-            "TOOL_UNKNOWN": self.TOOL_UNKNOWN.name,
-            "params_available": str(self.params.keys()),
-            **self.params,
+        return self._status_from_fields()
+
+    @contextlib.contextmanager
+    def heater_batch(self):
+        """Batch heater target changes. Each heater gets only its last target,
+        set when the outermost batch ends."""
+        self.heater_batch_depth += 1
+        try:
+            yield
+        finally:
+            self.heater_batch_depth -= 1
+            if self.heater_batch_depth == 0:
+                self.flush_heater_temps()
+
+    def flush_heater_temps(self):
+        """Set the pending targets of all heaters."""
+        heaters = list(self.heaters_pending_temp)
+        self.heaters_pending_temp.clear()
+        for heater in heaters:
+            temp = heater.pending_temp
+            heater.pending_temp = None
+            if temp is not None:
+                heater.apply_temp(temp)
+
+    def _heater_timers_status(self) -> dict:
+        """Absolute monotonic deadlines of the heater timers, None if not running."""
+        scheduler = self.heater_scheduler
+        return {
+            name: {
+                "standby": scheduler.deadline(
+                    heater.timer_heater_active_to_standby_delay),
+                "powerdown": scheduler.deadline(
+                    heater.timer_heater_standby_to_powerdown_delay),
+            }
+            for name, heater in self.all_heaters.items()
         }
-        return status
 
     def confirm_ready_for_toolchange(self, tool: KtcBaseToolClass):
         def _printer_is_homed_for_toolchange(self, required_axes: str = ""):
@@ -958,6 +1411,9 @@ class Ktc(KtcBaseClass, KtcConstantsClass):
             tool = self.all_tools_by_number[tool_nr]
         elif explicit:
             return None # type: ignore
+        elif self.pending_tool is not None:
+            # Commands for the active tool apply to the tool that will be selected.
+            tool = self.pending_tool
         else:
             if self.active_tool in self.INVALID_TOOLS:
                 raise gcmd.error("No tool specified and no active tool")
@@ -966,6 +1422,44 @@ class Ktc(KtcBaseClass, KtcConstantsClass):
             raise gcmd.error(f"Tool {tool.name} not allowed.")
         return tool  # type: ignore
 
+    def get_tools_from_gcmd(
+        self, gcmd: "gcode.GCodeCommand"
+    ) -> list["ktc_tool.KtcTool"]:
+        """Returns the tools selected by TOOLS, TOOLCHANGER, GROUP or ALL=1 in
+        the gcode command, or else the tool returned by get_tool_from_gcmd."""
+        tool_list = typing.cast(str, gcmd.get("TOOLS", None))
+        toolchanger = self.get_toolchanger_from_gcmd(gcmd, explicit=True)
+        group_name = typing.cast(str, gcmd.get("GROUP", None))
+        all_tools = gcmd.get_int("ALL", 0, minval=0, maxval=1)
+        selectors = [tool_list, toolchanger, group_name, all_tools or None]
+        if sum(x is not None for x in selectors) + (
+                gcmd.get("TOOL", None) is not None or gcmd.get("T", None) is not None) > 1:
+            raise gcmd.error("Use only one of TOOL, T, TOOLS, TOOLCHANGER, GROUP and ALL.")
+
+        if tool_list:
+            tools = []
+            for name in tool_list.replace(" ", "").split(","):
+                if name in self.all_tools:
+                    tools.append(self.all_tools[name])
+                elif name.lstrip("-").isdigit() and int(name) in self.all_tools_by_number:
+                    tools.append(self.all_tools_by_number[int(name)])
+                else:
+                    raise gcmd.error("Tool %s not found" % (name))
+        elif toolchanger is not None:
+            tools = list(toolchanger.tools.values())
+        elif group_name:
+            group = self.tool_groups.get(group_name.lower())
+            if group is None:
+                raise gcmd.error("ktc_tool_group %s not found" % (group_name))
+            tools = group.tools
+        elif all_tools:
+            tools = [tool for tool in self.all_tools.values()
+                     if tool not in self.INVALID_TOOLS]
+        else:
+            return [self.get_tool_from_gcmd(gcmd)]
+        # Keep the order and apply each tool once.
+        return list(dict.fromkeys(tools))
+
     def get_toolchanger_from_gcmd(
         self, gcmd: "gcode.GCodeCommand", explicit = False
     ) -> "ktc_toolchanger.KtcToolchanger":
@@ -992,25 +1486,9 @@ class Ktc(KtcBaseClass, KtcConstantsClass):
         return toolchanger
 
     def traverse_tools_from_deepest(self, func):
-        def _get_nested_tools(self: Ktc, toolchanger: "ktc_toolchanger.KtcToolchanger"):
-            nested_tools = []
-            for tool in toolchanger.tools.values():
-                if tool in self._tools_having_tc:
-                    nested_tools.append(
-                        _get_nested_tools(self, self._tools_having_tc[tool])
-                    )
-                nested_tools.append(tool)
-            return nested_tools
-
-        def _recursive_traverse_tools(self: Ktc, item, func):
-            if isinstance(item, list):
-                for i in item:
-                    _recursive_traverse_tools(self, i, func)
-            else:
-                func(item)
-
-        nested_tools = _get_nested_tools(self, self.default_toolchanger)
-        _recursive_traverse_tools(self, nested_tools, func)
+        """Run func for all tools, children before their parent tool."""
+        for tool in self.tool_tree.post_order:
+            func(tool)
 
     @staticmethod
     def tool_fan_speed_set(tool: "ktc_tool.KtcTool", speed: float):
@@ -1054,6 +1532,183 @@ class Ktc(KtcBaseClass, KtcConstantsClass):
                 + f"{heater.timer_heater_standby_to_powerdown_delay.duration}"
             )
 
+    def request_toolchange(self, tool: "ktc_tool.KtcTool") -> bool:
+        """Defer selecting the tool until the next extruding move if
+        elide_redundant_toolchanges is set and a print is running.
+        Returns False if the tool should be selected now."""
+        if not self.elide_redundant_toolchanges:
+            return False
+        if not self._is_printing():
+            # Flush so a manual toolchange is never reordered with a pending one.
+            self.flush_pending_toolchange()
+            return False
+        # The previous request never extruded so it is elided.
+        self.discard_pending_toolchange()
+        self.log.trace(f"KTC toolchange to {tool.name} deferred.")
+        self.pending_tool = tool
+        return True
+
+    def _is_printing(self) -> bool:
+        """Return True if a print is running."""
+        print_stats = self.printer.lookup_object("print_stats", None)
+        return print_stats is not None and print_stats.get_status(
+            self.printer.get_reactor().monotonic())["state"] == "printing"
+
+    def flush_pending_toolchange(self):
+        """Select the pending tool, if any, unless it is already active."""
+        tool = self.pending_tool
+        if tool is None:
+            return
+        self.pending_tool = None
+        if tool is self.active_tool:
+            self.log.trace(f"KTC toolchange to {tool.name} elided, already active.")
+            self.log.track_tool_toolchange_elided(tool)
+            return
+        self.run_with_profile(tool.select, final_selected=True)
+
+    def discard_pending_toolchange(self):
+        """Drop the pending toolchange, if any, counting it as elided."""
+        if self.pending_tool is None:
+            return
+        self.log.trace(f"KTC toolchange to {self.pending_tool.name} elided.")
+        self.log.track_tool_toolchange_elided(self.pending_tool)
+        self.pending_tool = None
+
+    def resolve_predictive_preheat(self, tool: "ktc_tool.KtcTool", eventtime: float):
+        """Called when changing to tool. Count the outcome of the predictive preheat
+        and undo it if another tool was predicted."""
+        preheat = self._preheat
+        if preheat is None:
+            return
+        self._preheat = None
+        self.heater_scheduler.cancel(preheat)
+        hit = preheat.tool is tool
+        self.log.track_prediction(hit, preheat.seconds_saved(eventtime))
+        if not hit:
+            preheat.undo()
+
+    def add_to_warm_pool(self, tool: "ktc_tool.KtcTool"):
+        """Make the tool the most recently selected in the warm pool and turn off
+        the least recently selected tools above warm_pool_size. Heaters shared
+        with a tool still in the pool are left on."""
+        if not self.warm_pool_size or not tool.extruder.heaters:
+            return
+        self.warm_pool[tool] = None
+        self.warm_pool.move_to_end(tool)
+        while len(self.warm_pool) > self.warm_pool_size:
+            evicted, _ = self.warm_pool.popitem(last=False)
+            pooled_heaters = {hs.name for t in self.warm_pool for hs in t.extruder.heaters}
+            if any(hs.name in pooled_heaters for hs in evicted.extruder.heaters):
+                continue
+            if evicted.extruder.state != HeaterStateType.OFF:
+                self.log.debug(f"Tool {evicted.name} evicted from the warm pool.")
+                evicted.set_heaters(heater_state=HeaterStateType.OFF)
+
+    def cancel_predictive_preheat(self):
+        """Undo the predictive preheat, if any, without counting it."""
+        preheat = self._preheat
+        if preheat is None:
+            return
+        self._preheat = None
+        self.heater_scheduler.cancel(preheat)
+        preheat.undo()
+
+    def schedule_predictive_preheat(self, tool: "ktc_tool.KtcTool", eventtime: float):
+        """Schedule the preheat of the tool most likely selected after tool, to be
+        at temperature when the change to it is expected."""
+        if not self.predictive_preheat:
+            return
+        prediction = self.log.predict_next_tool(tool)
+        if prediction is None:
+            return
+        next_name, probability, dwell = prediction
+        next_tool = self.all_tools.get(next_name)
+        if (probability < PREDICTIVE_PREHEAT_MIN_PROBABILITY or next_tool is None
+            or not next_tool.extruder.heaters):
+            return
+        # The longest heat-up of the tool heaters from standby temperature, which
+        # they have cooled to when the preheat starts. From the heat-up model
+        # or else the last measured wait.
+        ext = next_tool.extruder
+        heatup_times = []
+        for hs in ext.heaters:
+            heater = self.all_heaters[hs.name]
+            seconds = heater.heatup_model.seconds_to_target(
+                ext.active_temp - ext.standby_temp)
+            heatup_times.append(seconds if seconds is not None else heater.last_wait_time)
+        heatup_time = max((t for t in heatup_times if t is not None),
+                          default=DEFAULT_PREDICTIVE_PREHEAT_HEATUP_TIME)
+        self._preheat = KtcPredictivePreheat(self, next_tool, heatup_time)
+        self.heater_scheduler.schedule(
+            self._preheat,
+            max(eventtime + dwell - heatup_time - PREDICTIVE_PREHEAT_MARGIN, eventtime))
+        self.log.trace(f"Predicted tool {next_name} after {tool.name} "
+                       + f"with probability {probability:.2f} in {dwell:.1f}s.")
+
+    def _wrap_move_commands(self):
+        """Flush the pending toolchange and run the deferred temperature wait
+        before the first move that extrudes."""
+        for cmd in ("G0", "G1", "G2", "G3"):
+            prev_func = self.gcode.register_command(cmd, None)
+            if prev_func is None:
+                continue
+
+            def func(gcmd, prev_func=prev_func):
+                if ((self.pending_tool is not None
+                     or self.pending_temperature_wait)
+                    and self.is_extruding_move(gcmd)):
+                    self.flush_pending_toolchange()
+                    self.enforce_pending_temperature_wait()
+                prev_func(gcmd)
+
+            self.gcode.register_command(cmd, func)
+
+    def is_extruding_move(self, gcmd: "gcode.GCodeCommand") -> bool:
+        """Return True if the move command has a positive E movement."""
+        e = gcmd.get_float("E", None)
+        if e is None:
+            return False
+        gcode_move = self.printer.lookup_object("gcode_move")
+        if gcode_move.absolute_coord and gcode_move.absolute_extrude:
+            e += gcode_move.base_position[3] - gcode_move.last_position[3]
+        return e > 0.
+
+    cmd_KTC_TOOLCHANGE_FLUSH_help = ("Select the tool requested by KTC_T# now "
+                                     + "when elide_redundant_toolchanges defers it "
+                                     + "and run a deferred temperature wait.")
+    def cmd_KTC_TOOLCHANGE_FLUSH(self, gcmd):  # pylint: disable=invalid-name, unused-argument
+        self.flush_pending_toolchange()
+        self.enforce_pending_temperature_wait()
+
+    cmd_KTC_PLAN_TOOLCHANGE_help = ("Report the tool selects and deselects needed to "
+                                    + "change from the active tool to the specified tool.")
+    def cmd_KTC_PLAN_TOOLCHANGE(self, gcmd):  # pylint: disable=invalid-name
+        tool = self.get_tool_from_gcmd(gcmd, allow_invalid_active_tool=False, explicit=True)
+        if tool is None:
+            raise gcmd.error("No tool specified.")
+        if self.active_tool == self.TOOL_UNKNOWN:
+            raise gcmd.error("Active tool is unknown. Can't plan a toolchange.")
+        plan = self.tool_tree.plan_toolchange(self.active_tool, tool)
+        legacy_count = self.tool_tree.legacy_plan_length(self.active_tool, tool)
+        msg = f"KTC toolchange plan from {self.active_tool.name} to {tool.name}:\n"
+        for i, (action, t) in enumerate(plan, 1):
+            msg += f"{i}. {action.value.capitalize()} {t.name}\n"
+        msg += f"{len(plan)} actions. Previous logic would run {legacy_count}."
+        gcmd.respond_info(msg)
+
+    cmd_KTC_DEBUG_BENCHMARK_help = ("COMMAND=<gcode> [COUNT=<n>] "
+                                    + "Report the mean time to run a G-code command.")
+    def cmd_KTC_DEBUG_BENCHMARK(self, gcmd):  # pylint: disable=invalid-name
+        command = typing.cast(str, gcmd.get("COMMAND"))
+        count = typing.cast(int, gcmd.get_int("COUNT", 100, minval=1, maxval=100000))
+        start = time.perf_counter()
+        for _ in range(count):
+            self.gcode.run_script_from_command(command)
+        elapsed = time.perf_counter() - start
+        gcmd.respond_info(
+            f"{command}: {count} runs in {elapsed:.3f}s, "
+            + f"{elapsed / count * 1000000:.0f} us per command.")
+
     cmd_KTC_DEBUG_TOOLS_help = "Debugging tools."
     def cmd_KTC_DEBUG_TOOLS(
         self, gcmd
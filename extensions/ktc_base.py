@@ -9,12 +9,15 @@
 #
 from __future__ import annotations
 import ast, typing, re
+import collections.abc
 import cProfile, pstats, io
 from enum import IntEnum, Enum
 from .ktc_heater import (   # pylint: disable=relative-beyond-top-level
     KtcToolExtruder,
     DEFAULT_HEATER_ACTIVE_TO_STANDBY_DELAY,
     DEFAULT_HEATER_STANDBY_TO_POWERDOWN_DELAY,
+    DEFAULT_HEATER_ADAPTIVE_STANDBY_DELAY_MIN,
+    DEFAULT_HEATER_ADAPTIVE_STANDBY_DELAY_MAX,
 )
 
 
@@ -45,6 +48,11 @@ PARAMS_TO_INHERIT = {"_engage_gcode": "",
                          DEFAULT_HEATER_ACTIVE_TO_STANDBY_DELAY,
                      "_heater_standby_to_powerdown_delay_in_config":
                          DEFAULT_HEATER_STANDBY_TO_POWERDOWN_DELAY,
+                     "_heater_adaptive_standby_delay_in_config": False,
+                     "_heater_adaptive_standby_delay_min_in_config":
+                         DEFAULT_HEATER_ADAPTIVE_STANDBY_DELAY_MIN,
+                     "_heater_adaptive_standby_delay_max_in_config":
+                         DEFAULT_HEATER_ADAPTIVE_STANDBY_DELAY_MAX,
                      }
 
 class KtcConfigurableEnum(Enum):
@@ -68,8 +76,44 @@ class KtcConfigurableEnum(Enum):
     def __str__(self):
         return f"'{self.name}'"
 
+class KtcStatusProxy(collections.abc.Mapping):
+    '''Read-only mapping of the status of a KTC object used as template context.
+    Each field is computed from the _STATUS_FIELDS of the object only when it is
+    read by the template and then kept for the lifetime of the proxy.'''
+    __slots__ = ("_obj", "_cache")
+
+    def __init__(self, obj: 'KtcBaseClass'):
+        self._obj = obj
+        self._cache: dict[str, typing.Any] = {}
+
+    def __getitem__(self, key: str):
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        getter = self._obj._STATUS_FIELDS.get(key)    # pylint: disable=protected-access
+        if getter is not None:
+            value = getter(self._obj)
+        else:
+            value = self._obj.params[key]   # Raises KeyError if not found.
+        self._cache[key] = value
+        return value
+
+    def __iter__(self):
+        fields = self._obj._STATUS_FIELDS     # pylint: disable=protected-access
+        yield from fields
+        yield from (key for key in self._obj.params if key not in fields)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
 class KtcBaseClass:
     """Base class for KTC. Contains common methods and properties."""
+    # Attributes holding G-code that is compiled to templates for this object.
+    _GCODE_TEMPLATE_PARAMS: tuple[str, ...] = ()
+    # Status fields as name: getter(self). Custom params_* are added after these.
+    _STATUS_FIELDS: dict[str, typing.Callable[[typing.Any], typing.Any]] = {}
+
     def __init__(self, config: "configfile.ConfigWrapper"): # type: ignore
         self.config = typing.cast('configfile.ConfigWrapper', config)
         self.name: str = ""
@@ -86,6 +130,12 @@ class KtcBaseClass:
         self.force_deselect_when_parent_deselects: bool = None  # type: ignore
         self.parent_must_be_selected_on_deselect: bool = None  # type: ignore
 
+        # Compiled G-code templates keyed on the attribute holding the source.
+        # Each value is a tuple of the source string and the compiled template.
+        self._gcode_templates: dict[str, tuple[str, 'klippy_gcode_macro.TemplateWrapper']] = {}
+        self.gcode_template_cache_hits = 0
+        self.gcode_template_cache_misses = 0
+
         # If this is a empty object then don't load the config.
         if config is None:
             return
@@ -123,6 +173,13 @@ class KtcBaseClass:
             "heater_active_to_standby_delay", None, 0.1)    # type: ignore
         self._heater_standby_to_powerdown_delay_in_config = self.config.getfloat(
             "heater_standby_to_powerdown_delay", None, 0.1) # type: ignore
+        # Learn the active to standby delay from the time the tool is not used.
+        self._heater_adaptive_standby_delay_in_config = self.config.getboolean(
+            "heater_adaptive_standby_delay", None)  # type: ignore
+        self._heater_adaptive_standby_delay_min_in_config = self.config.getfloat(
+            "heater_adaptive_standby_delay_min", None, 0.1)  # type: ignore
+        self._heater_adaptive_standby_delay_max_in_config = self.config.getfloat(
+            "heater_adaptive_standby_delay_max", None, 0.1)  # type: ignore
 
         # Fans are a list of lists with the first value being the name
         # of the fan and the second value being the speed scaling 0-1.
@@ -242,6 +299,45 @@ class KtcBaseClass:
                 if v not in self.params:
                     self.params[v] = parent.params[v]   # type: ignore
 
+    def _build_gcode_template_cache(self):
+        '''Compile the G-code templates used by this object.
+        Called once all inherited parameters are configured.'''
+        self._gcode_templates = {}
+        for attr in self._GCODE_TEMPLATE_PARAMS:
+            self.get_gcode_template(attr)
+
+    def get_gcode_template(self, attr: str) -> 'klippy_gcode_macro.TemplateWrapper':
+        '''Return the compiled template for the G-code stored in the attribute attr.
+        The template is only recompiled when the source string has changed.'''
+        source = getattr(self, attr)
+        cached = self._gcode_templates.get(attr)
+        if cached is not None and cached[0] == source:
+            self.gcode_template_cache_hits += 1
+            return cached[1]
+
+        self.gcode_template_cache_misses += 1
+        gcode_macro = typing.cast('klippy_gcode_macro.PrinterGCodeMacro',
+                                  self.printer.lookup_object("gcode_macro"))
+        template = gcode_macro.load_template(self.config, "", source)
+        self._gcode_templates[attr] = (source, template)
+        return template
+
+    def run_gcode_template(self, attr: str):
+        '''Run the G-code template stored in the attribute attr.
+        myself, ktc and STATE_TYPE are available to the template.'''
+        template = self.get_gcode_template(attr)
+        context = template.create_template_context()
+        context['myself'] = KtcStatusProxy(self)
+        context['ktc'] = KtcStatusProxy(self._ktc)
+        context['STATE_TYPE'] = self.StateType
+        template.run_gcode_from_command(context)
+
+    def _status_from_fields(self) -> dict:
+        '''Return a snapshot of all status fields and custom parameters.'''
+        status = {key: getter(self) for key, getter in self._STATUS_FIELDS.items()}
+        status.update(self.params)
+        return status
+
     @staticmethod
     def get_params_dict_from_config(config: 'configfile.ConfigWrapper'):
         """Get a dict of atributes starting with params_ from the config."""
@@ -333,14 +429,15 @@ class KtcBaseClass:
         v: dict = self._ktc_persistent.content.get("State", {})
         return v.get(c, {})
 
-    def persistent_state_set(self, key: str, value: typing.Any):
-        '''Set the persistent state for the object. Use persistent_state to get the state.'''
+    def persistent_state_set(self, key: str, value: typing.Any, force_save: bool = True):
+        '''Set the persistent state for the object. Use persistent_state to get the state.
+        With force_save False the file is written by the next save timer or force_save.'''
         c = self._get_type_for_persistent_state()
 
         state: dict = self._ktc_persistent.content.get("State", {}).get(c, {})
         state[key] = value
 
-        self._ktc_persistent.save_variable(c, str(state), "State", True)
+        self._ktc_persistent.save_variable(c, str(state), "State", force_save)
 
     def _get_type_for_persistent_state(self) -> str:
         if self._ktc_persistent is None:
@@ -400,6 +497,8 @@ class KtcBaseClass:
 
 class KtcBaseChangerClass(KtcBaseClass):
     '''Base class for toolchangers. Contains common methods and properties.'''
+    _GCODE_TEMPLATE_PARAMS = ("_init_gcode", "_engage_gcode", "_disengage_gcode")
+
     def __init__(self, config: 'configfile.ConfigWrapper'):
         super().__init__(config)
         self.name: str = str(config.get_name()).split(" ", 1)[1]
@@ -407,11 +506,11 @@ class KtcBaseChangerClass(KtcBaseClass):
         self.parent_tool: 'ktc_tool.KtcTool' = None # type: ignore
         # self.selected_tool = KtcConstantsClass.TOOL_NONE
         self.tools: dict[str, 'ktc_tool.KtcTool'] = {}
-        self._engage_gcode_template: klippy_gcode_macro.GCodeMacro = None # type: ignore
-        self._disengage_gcode_template: klippy_gcode_macro.GCodeMacro = None # type: ignore
 
 class KtcBaseToolClass(KtcBaseClass):
     '''Base class for tools. Contains common methods and properties.'''
+    _GCODE_TEMPLATE_PARAMS = ("_tool_select_gcode", "_tool_deselect_gcode")
+
     def __init__(self, config: "configfile.ConfigWrapper",
                  name: str = "", number: int = TOOL_NUMBERLESS_N):
         super().__init__(config)
@@ -4,7 +4,7 @@
 # Copyright (C) 2024 Andrei Ignat <andrei@ignat.se>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import typing, dataclasses
+import typing, dataclasses, heapq, itertools, collections, math, logging
 from enum import IntEnum, unique
 
 # Only import these modules in Dev environment. Consult Dev_doc.md for more info.
@@ -13,12 +13,35 @@ if typing.TYPE_CHECKING:
     from ...klipper.klippy.extras import heaters as klippy_heaters
 
     # from ...klipper.klippy.extras import gcode_macro as klippy_gcode_macro
-    from . import ktc_log, ktc_toolchanger, ktc_tool, ktc
+    from . import ktc_log, ktc_toolchanger, ktc_tool, ktc, ktc_persisting
 
 DEFAULT_HEATER_ACTIVE_TO_STANDBY_DELAY = 0.1
 DEFAULT_HEATER_STANDBY_TO_POWERDOWN_DELAY = 600
+DEFAULT_HEATER_ADAPTIVE_STANDBY_DELAY_MIN = 0.1
+DEFAULT_HEATER_ADAPTIVE_STANDBY_DELAY_MAX = 300.0
 NOW = 0.1
 NEVER = 0
+# Heat-up time assumed for predictive preheat when a tool has no measured wait,
+# and the seconds to start the preheat earlier than the measured heat-up time.
+DEFAULT_PREDICTIVE_PREHEAT_HEATUP_TIME = 30.0
+PREDICTIVE_PREHEAT_MARGIN = 2.0
+# Lowest probability of the next tool to preheat it.
+PREDICTIVE_PREHEAT_MIN_PROBABILITY = 0.5
+# Heat-up sampling: seconds between samples, the lowest raise of the target
+# that is sampled and the distance from target where the heater is at target.
+HEATUP_SAMPLE_INTERVAL = 1.0
+HEATUP_SAMPLE_MIN_RISE = 5.0
+HEATUP_TARGET_TOLERANCE = 1.0
+# Weight kept by older samples for each new sample, to follow changes slowly.
+HEATUP_MODEL_FORGETTING = 0.995
+# Samples needed before the heat-up model is used.
+HEATUP_MODEL_MIN_SAMPLES = 10
+# Seconds between checks of the heaters heating within the power budget.
+POWER_BUDGET_POLL_INTERVAL = 0.5
+# Idle intervals kept for the adaptive standby delay and how they are weighted.
+IDLE_INTERVALS_KEPT = 10
+IDLE_INTERVAL_EWMA_ALPHA = 0.3
+IDLE_INTERVAL_PERCENTILE = 0.75
 
 
 @unique
@@ -80,6 +103,54 @@ class KtcHeaterSettings:
         return {"name": self.name, "temperature_offset": self.temperature_offset}
 
 
+class KtcIdleIntervals:
+    """Time a tool is not used, from its heaters leaving ACTIVE until ACTIVE again.
+
+    The estimate of the next interval is the larger of an exponentially weighted
+    mean and a percentile of the last intervals, so one short interval doesn't
+    make the tool cool down before a normal return."""
+
+    def __init__(self):
+        self.intervals: collections.deque[float] = collections.deque(
+            maxlen=IDLE_INTERVALS_KEPT)
+        self.ewma: typing.Optional[float] = None
+        self._idle_since: typing.Optional[float] = None
+
+    def start(self, eventtime: float):
+        self._idle_since = eventtime
+
+    def end(self, eventtime: float):
+        if self._idle_since is None:
+            return
+        interval = eventtime - self._idle_since
+        self._idle_since = None
+        self.intervals.append(interval)
+        if self.ewma is None:
+            self.ewma = interval
+        else:
+            self.ewma += IDLE_INTERVAL_EWMA_ALPHA * (interval - self.ewma)
+
+    def estimate(self) -> typing.Optional[float]:
+        """Return the expected next idle interval or None if there are no intervals."""
+        if self.ewma is None:
+            return None
+        ordered = sorted(self.intervals)
+        percentile = ordered[min(int(len(ordered) * IDLE_INTERVAL_PERCENTILE),
+                                 len(ordered) - 1)]
+        return max(self.ewma, percentile)
+
+    def standby_delay(self, min_delay: float, max_delay: float) -> typing.Optional[float]:
+        """Return the active to standby delay that keeps the heaters active until
+        the tool is expected back. Tools not expected back within max_delay go to
+        standby after min_delay. Returns None if there are no intervals."""
+        estimate = self.estimate()
+        if estimate is None:
+            return None
+        if estimate > max_delay:
+            return min_delay
+        return max(estimate, min_delay)
+
+
 class KtcToolExtruder:
     def __init__(self, tool: "ktc_tool.KtcTool"):
         self._tool = tool
@@ -90,6 +161,11 @@ class KtcToolExtruder:
         self._standby_to_powerdown_delay = DEFAULT_HEATER_STANDBY_TO_POWERDOWN_DELAY
         self.heaters: list["KtcHeaterSettings"] = []
         # dataclasses.field(default_factory=list)
+        # Adaptive standby delay, used instead of active_to_standby_delay if enabled.
+        self.adaptive_standby_delay = False
+        self.adaptive_standby_delay_min = DEFAULT_HEATER_ADAPTIVE_STANDBY_DELAY_MIN
+        self.adaptive_standby_delay_max = DEFAULT_HEATER_ADAPTIVE_STANDBY_DELAY_MAX
+        self.idle_intervals = KtcIdleIntervals()
 
         if tool.name not in ("tool_unknown", "tool_none"):
             self._ktc = tool._ktc
@@ -97,14 +173,45 @@ class KtcToolExtruder:
     def heater_names(self) -> list[str]:
         return [heater.name for heater in self.heaters]
 
+    def _set_state(self, value: HeaterStateType):
+        """Set the state and keep the count of tools holding each heater ACTIVE."""
+        was_active = self._state == HeaterStateType.ACTIVE
+        self._state = value
+        is_active = value == HeaterStateType.ACTIVE
+        if was_active != is_active and self.heaters:
+            for hs in self.heaters:
+                self._tool._ktc.all_heaters[hs.name].active_tools_count += (
+                    1 if is_active else -1)
+            eventtime = self._tool.printer.get_reactor().monotonic()
+            if is_active:
+                self.idle_intervals.end(eventtime)
+            else:
+                self.idle_intervals.start(eventtime)
+
+    def effective_standby_to_powerdown_delay(self) -> float:
+        """Return NEVER for tools kept in the warm pool, otherwise
+        standby_to_powerdown_delay."""
+        if self._tool in self._tool._ktc.warm_pool:
+            return NEVER
+        return self.standby_to_powerdown_delay
+
+    def effective_active_to_standby_delay(self) -> float:
+        """Return the learned standby delay if adaptive and learned,
+        otherwise active_to_standby_delay."""
+        if self.adaptive_standby_delay:
+            delay = self.idle_intervals.standby_delay(
+                self.adaptive_standby_delay_min, self.adaptive_standby_delay_max)
+            if delay is not None:
+                return delay
+        return self.active_to_standby_delay
+
     @property
     def state(self):
         return self._state
 
     @state.setter
     def state(self, value: HeaterStateType):
-        self._state = value
-        _ktc = self._tool._ktc
+        self._set_state(value)
         self._tool._ktc.log.trace(
             f"In extr. Setting heater state to {value} "
             + f"for tool {self._tool.name}"
@@ -114,8 +221,8 @@ class KtcToolExtruder:
             heater: KtcHeater = self._tool._ktc.all_heaters[heater_settings.name]
             heater.heater_active_temp = heater_settings.temperature_offset + self.active_temp
             heater.standby_temp = heater_settings.temperature_offset + self.standby_temp
-            heater.active_to_standby_delay = self.active_to_standby_delay
-            heater.standby_to_powerdown_delay = self.standby_to_powerdown_delay
+            heater.active_to_standby_delay = self.effective_active_to_standby_delay()
+            heater.standby_to_powerdown_delay = self.effective_standby_to_powerdown_delay()
             self._tool._ktc.log.trace(
                 f"Setting heater options for heater {heater.name} "
                 + f"{heater.heater_active_temp=}, {heater.standby_temp=}, "
@@ -136,20 +243,9 @@ class KtcToolExtruder:
             return
 
         # For STANDY and OFF, check if the heater is active on another tool.
-        heaters_active_with_other_tool: list[str] = []
-        invalid_tools = (
-                self._tool,
-                self._tool._ktc.TOOL_NONE,
-                self._tool._ktc.TOOL_UNKNOWN,
-                None,
-            )
-        for tool in self._tool._ktc.all_tools.values():
-            if tool not in invalid_tools:
-                if tool.extruder.state == HeaterStateType.ACTIVE:
-                    heaters_active_with_other_tool.extend(tool.extruder.heater_names())
-
+        # This tool is no longer counted as the state is not ACTIVE.
         for hs in self.heaters:
-            if hs.name not in heaters_active_with_other_tool:
+            if self._tool._ktc.all_heaters[hs.name].active_tools_count == 0:
                 if value == HeaterStateType.STANDBY:
                     self._tool._ktc.log.trace(
                         f"Setting heater state to STANDBY for tool {self._tool.name}"
@@ -164,7 +260,7 @@ class KtcToolExtruder:
                 )
                 self._tool._ktc.log.track_heater_active_end(self._tool)
                 self._tool._ktc.log.track_heater_standby_end(self._tool)
-                self._state = HeaterStateType.OFF
+                self._set_state(HeaterStateType.OFF)
 
     @property
     def active_temp(self):
@@ -235,15 +331,265 @@ class KtcToolExtruder:
                     ].timer_heater_standby_to_powerdown_delay.counting_down
                 ):
                     self._tool._ktc.all_heaters[hs.name].standby_to_powerdown_delay = (
-                        value
+                        self.effective_standby_to_powerdown_delay()
                     )
 
 
+class KtcHeatupModel:
+    """First order heat-up model of a heater, fitted online by least squares.
+
+    The heating rate in degrees per second is modeled as
+    rate = offset + slope * (target - temperature).
+    Only the weighted sums are kept, older samples weigh less."""
+
+    def __init__(self, sums: typing.Optional[typing.Sequence[float]] = None):
+        # Sums of weight, x, y, x*x and x*y with x the distance to target and y the rate.
+        self.sums = [float(v) for v in sums] if sums else [0.] * 5
+
+    def add(self, distance: float, rate: float):
+        self.sums = [v * HEATUP_MODEL_FORGETTING for v in self.sums]
+        for i, v in enumerate((1., distance, rate, distance * distance, distance * rate)):
+            self.sums[i] += v
+
+    @property
+    def samples(self) -> float:
+        return self.sums[0]
+
+    def coefficients(self) -> typing.Optional[typing.Tuple[float, float]]:
+        """Return (offset, slope) or None if there are too few samples."""
+        n, sx, sy, sxx, sxy = self.sums
+        if n < HEATUP_MODEL_MIN_SAMPLES:
+            return None
+        variance = n * sxx - sx * sx
+        if variance <= 1e-9 * n * n:
+            # All samples at the same distance, only the mean rate is known.
+            return sy / n, 0.
+        slope = (n * sxy - sx * sy) / variance
+        return (sy - slope * sx) / n, slope
+
+    def seconds_to_target(self, distance: float) -> typing.Optional[float]:
+        """Return the seconds to heat from distance degrees below target until
+        within HEATUP_TARGET_TOLERANCE. None if unknown or the heater can't get there."""
+        if distance <= HEATUP_TARGET_TOLERANCE:
+            return 0.
+        coefficients = self.coefficients()
+        if coefficients is None:
+            return None
+        offset, slope = coefficients
+        rate_start = offset + slope * distance
+        rate_end = offset + slope * HEATUP_TARGET_TOLERANCE
+        if rate_start <= 0. or rate_end <= 0.:
+            return None
+        if abs(slope) < 1e-9:
+            return (distance - HEATUP_TARGET_TOLERANCE) / offset
+        # Integral of 1 / rate over the distance.
+        return math.log(rate_start / rate_end) / slope
+
+
+class KtcHeatupSampler:
+    """Samples the temperature of a heater while it heats up to a raised
+    target and adds the rates to the heater model. Run by the KtcHeaterScheduler."""
+
+    def __init__(self, heater: "KtcHeater"):
+        self.heater = heater
+        self.target = 0.
+        self._last: typing.Optional[typing.Tuple[float, float]] = None
+
+    def start(self, target: float, eventtime: float):
+        self.target = target
+        self._last = None
+        self.heater.scheduler.schedule(self, eventtime + HEATUP_SAMPLE_INTERVAL)
+
+    def scheduled_event(self, eventtime):
+        temp, target = self.heater.klippy_heater.get_temp(eventtime)
+        if target != self.target:
+            # The target was changed, this ramp is done.
+            self._last = None
+            return
+        if self._last is not None:
+            last_time, last_temp = self._last
+            # Rate at the mean distance to target over the sample interval.
+            self.heater.heatup_model.add(
+                target - (temp + last_temp) / 2., (temp - last_temp) / (eventtime - last_time))
+        if target - temp <= HEATUP_TARGET_TOLERANCE:
+            self._last = None
+            self.heater.persist_heatup_model()
+            return
+        self._last = (eventtime, temp)
+        self.heater.scheduler.schedule(self, eventtime + HEATUP_SAMPLE_INTERVAL)
+
+
+class KtcSettlingWindow:
+    """Temperatures of a heater over the last window seconds, used to tell a
+    heater that will stay within tolerance from one passing through it."""
+
+    def __init__(self, window: float):
+        self.window = window
+        self.samples: collections.deque[typing.Tuple[float, float]] = collections.deque()
+
+    def add(self, eventtime: float, temp: float):
+        self.samples.append((eventtime, temp))
+        while self.samples[0][0] < eventtime - self.window:
+            self.samples.popleft()
+
+    def slope(self) -> typing.Optional[float]:
+        """Least squares rate in degrees per second over the window, None if
+        the samples span less than half the window."""
+        if (len(self.samples) < 3
+            or self.samples[-1][0] - self.samples[0][0] < self.window / 2):
+            return None
+        n = len(self.samples)
+        mean_t = sum(t for t, _ in self.samples) / n
+        mean_temp = sum(temp for _, temp in self.samples) / n
+        variance = sum((t - mean_t) ** 2 for t, _ in self.samples)
+        return sum((t - mean_t) * (temp - mean_temp)
+                   for t, temp in self.samples) / variance
+
+    def is_settled(self, target: float, tolerance: float) -> bool:
+        """Return True if the temperature is within tolerance of target and, at the
+        current rate, still is one window from now."""
+        if not self.samples:
+            return False
+        temp = self.samples[-1][1]
+        slope = self.slope()
+        return (slope is not None and abs(temp - target) <= tolerance
+                and abs(temp + slope * self.window - target) <= tolerance)
+
+
+class KtcHeaterPowerBudget:
+    """Limits the total power of the heaters heating up at the same time.
+
+    A raised target of a heater with a configured power is only set when the
+    power of the heaters still heating up, plus this heater, is within the
+    budget. Otherwise it is queued and started when enough heaters are at
+    target. Queued heaters start by priority: heaters of the active tool,
+    then other ACTIVE heaters, then the rest. Lowered targets are never queued.
+    One heater is always allowed to heat even if it is over the budget.
+    Run by the KtcHeaterScheduler."""
+
+    def __init__(self, printer: "klippy.Printer", budget: float):
+        self.printer = printer
+        self.reactor: "reactor.Reactor" = printer.get_reactor()
+        self.budget = budget
+        # Heaters heating up and their targets.
+        self.heating: dict["KtcHeater", float] = {}
+        # Queued heaters and their (target, request order).
+        self.queued: dict["KtcHeater", typing.Tuple[float, int]] = {}
+        self._sequence = itertools.count()
+        self._ramp_start: typing.Optional[float] = None
+        # Seconds from the first request until all heaters were at target, last time.
+        self.last_all_ready_time: typing.Optional[float] = None
+
+    @property
+    def scheduler(self) -> "KtcHeaterScheduler":
+        return typing.cast("ktc.Ktc", self.printer.lookup_object("ktc")).heater_scheduler
+
+    def configure_heaters(self, heaters: typing.Iterable["KtcHeater"]):
+        """Check the budget against the power of all heaters. Called by Ktc at
+        connect, when all heaters are loaded, so it does not depend on the
+        order of the config sections."""
+        if self.budget <= 0.:
+            return
+        limited = [heater for heater in heaters if heater.power > 0.]
+        if not limited:
+            raise self.printer.config_error(
+                "heater_power_budget is set in [ktc] but no [ktc_heater] section "
+                + "has power set.")
+        for heater in limited:
+            if heater.power > self.budget:
+                logging.warning("KTC: Heater %s power %.0fW is over heater_power_budget "
+                                "%.0fW and only heats alone.",
+                                heater.name, heater.power, self.budget)
+
+    @property
+    def power_used(self) -> float:
+        return sum(heater.power for heater in self.heating)
+
+    def request(self, heater: "KtcHeater", temp: float, eventtime: float) -> bool:
+        """Called before setting the target of the heater.
+        Returns True if the target is queued and must not be set now."""
+        self.queued.pop(heater, None)
+        if self.budget <= 0. or heater.power <= 0.:
+            return False
+        current_temp, _ = heater.klippy_heater.get_temp(eventtime)
+        if temp - current_temp <= HEATUP_TARGET_TOLERANCE:
+            self.heating.pop(heater, None)
+            return False
+        if heater in self.heating or not self.heating or (
+            self.power_used + heater.power <= self.budget):
+            self._start(heater, temp, eventtime)
+            return False
+        self.queued[heater] = (temp, next(self._sequence))
+        heater.log.debug(f"Heater {heater.name} queued to {temp} by the power budget.")
+        return True
+
+    def cancel(self, heater: "KtcHeater"):
+        """Drop the queued target of the heater, if any."""
+        self.queued.pop(heater, None)
+
+    def queued_temp(self, heater_name: str) -> typing.Optional[float]:
+        """Return the queued target of the heater or None if not queued."""
+        for heater, (temp, _) in self.queued.items():
+            if heater.name == heater_name:
+                return temp
+        return None
+
+    def _start(self, heater: "KtcHeater", temp: float, eventtime: float):
+        if self._ramp_start is None:
+            self._ramp_start = eventtime
+        self.heating[heater] = temp
+        self.scheduler.schedule(self, eventtime + POWER_BUDGET_POLL_INTERVAL)
+
+    def _priority(self, heater: "KtcHeater") -> int:
+        active_tool = typing.cast("ktc.Ktc", self.printer.lookup_object("ktc")).active_tool
+        if heater.tools and any(tool is active_tool for tool in heater.tools):
+            return 0
+        return 1 if heater.state == HeaterStateType.ACTIVE else 2
+
+    def scheduled_event(self, eventtime):
+        for heater, temp in list(self.heating.items()):
+            current_temp, target = heater.klippy_heater.get_temp(eventtime)
+            if target != temp or temp - current_temp <= HEATUP_TARGET_TOLERANCE:
+                del self.heating[heater]
+        for heater in sorted(self.queued, key=lambda h: (self._priority(h), self.queued[h][1])):
+            if self.heating and self.power_used + heater.power > self.budget:
+                break
+            temp, _ = self.queued.pop(heater)
+            self._start(heater, temp, eventtime)
+            heater.set_klippy_temp(temp, eventtime)
+        if self.heating:
+            self.scheduler.schedule(self, eventtime + POWER_BUDGET_POLL_INTERVAL)
+        elif self._ramp_start is not None:
+            self.last_all_ready_time = eventtime - self._ramp_start
+            self._ramp_start = None
+            typing.cast("ktc_log.KtcLog", self.printer.lookup_object("ktc_log")).debug(
+                "All heaters at target %.1fs after the first heat-up request."
+                % self.last_all_ready_time)
+
+    def get_status(self, eventtime=None):  # pylint: disable=unused-argument
+        return {
+            "budget": self.budget,
+            "power_used": self.power_used,
+            "heating": [heater.name for heater in self.heating],
+            "queued": [heater.name for heater in self.queued],
+            "last_all_ready_time": self.last_all_ready_time,
+        }
+
+
 class KtcHeater:
     def __init__(self, config: "configfile.ConfigWrapper"):
         self.printer: "klippy.Printer" = config.get_printer()
         self.name = typing.cast(str, config.get_name().split(" ", 1)[1])
         self.temperature_offset = 0.0
+        # Power in watts used by the heater power budget. 0 is not limited.
+        self.power = typing.cast(float, config.getfloat("power", 0., minval=0.))
+
+        # Tools having this heater. Added when the tools are configured.
+        self.tools: list["ktc_tool.KtcTool"] = []
+        # Number of tools having this heater with the extruder state ACTIVE.
+        self.active_tools_count = 0
+        # Seconds the last temperature wait took for this heater to be in tolerance.
+        self.last_wait_time: typing.Optional[float] = None
 
         self._state = HeaterStateType.OFF
         # Timer to set temperature to standby temperature
@@ -272,6 +618,95 @@ class KtcHeater:
             "klippy_heaters.Heater",
             self.printer.lookup_object("heaters").lookup_heater(self.name),
         )
+        # Target waiting for the heater batch to end, None if no target is pending.
+        self.pending_temp: typing.Optional[float] = None
+
+        # Heat-up model, learned while heating and persisted between restarts.
+        self._ktc_persistent = typing.cast(
+            "ktc_persisting.KtcPersisting", self.printer.lookup_object("ktc_persisting"))
+        self.heatup_model = KtcHeatupModel(
+            self._ktc_persistent.content.get("State", {}).get(
+                self._persistent_name(), {}).get("heatup_model"))
+        self._heatup_sampler = KtcHeatupSampler(self)
+
+    def _persistent_name(self) -> str:
+        return "ktc_heater_" + self.name.lower()
+
+    def persist_heatup_model(self):
+        self._ktc_persistent.save_variable(
+            self._persistent_name(),
+            str({"heatup_model": [round(v, 4) for v in self.heatup_model.sums]}),
+            "State")
+
+    @property
+    def log(self) -> "ktc_log.KtcLog":
+        return typing.cast("ktc_log.KtcLog", self.printer.lookup_object("ktc_log"))
+
+    @property
+    def scheduler(self) -> "KtcHeaterScheduler":
+        return self._ktc.heater_scheduler
+
+    def estimated_seconds_to_target(self, eventtime: float,
+                                    target: typing.Optional[float] = None
+                                    ) -> typing.Optional[float]:
+        """Return the estimated seconds to heat from the current temperature to
+        target, by default the current target. None if not known."""
+        temp, current_target = self.klippy_heater.get_temp(eventtime)
+        if target is None:
+            target = current_target
+        return self.heatup_model.seconds_to_target(target - temp)
+
+    def get_status(self, eventtime=None):
+        if eventtime is None:
+            eventtime = self.printer.get_reactor().monotonic()
+        coefficients = self.heatup_model.coefficients()
+        return {
+            "state": self.state,
+            "active_temp": self.heater_active_temp,
+            "standby_temp": self.standby_temp,
+            "active_tools_count": self.active_tools_count,
+            "last_wait_time": self.last_wait_time,
+            "estimated_seconds_to_target": self.estimated_seconds_to_target(eventtime),
+            "heatup_rate_offset": coefficients[0] if coefficients else None,
+            "heatup_rate_slope": coefficients[1] if coefficients else None,
+            "heatup_samples": round(self.heatup_model.samples, 1),
+        }
+
+    @property
+    def _ktc(self) -> "ktc.Ktc":
+        return typing.cast("ktc.Ktc", self.printer.lookup_object("ktc"))
+
+    def set_temp(self, temp: float):
+        """Set the target temperature of the klippy heater.
+        While ktc is batching heater changes only the last target is kept
+        and set when the batch ends. Setting the current target is skipped."""
+        ktc = self._ktc
+        if ktc.heater_batch_depth > 0:
+            if self.pending_temp is not None:
+                ktc.heater_set_temp_suppressed += 1
+            self.pending_temp = temp
+            ktc.heaters_pending_temp[self] = None
+            return
+        self.apply_temp(temp)
+
+    def apply_temp(self, temp: float):
+        """Set the target temperature of the klippy heater unless already set."""
+        if temp == self.klippy_heater.target_temp:
+            self._ktc.heater_power_budget.cancel(self)
+            self._ktc.heater_set_temp_suppressed += 1
+            return
+        eventtime = self.printer.get_reactor().monotonic()
+        if self._ktc.heater_power_budget.request(self, temp, eventtime):
+            return
+        self.set_klippy_temp(temp, eventtime)
+
+    def set_klippy_temp(self, temp: float, eventtime: float):
+        """Set the target of the klippy heater and learn the heat-up curve
+        when the target is raised."""
+        self.klippy_heater.set_temp(temp)
+        current_temp, _ = self.klippy_heater.get_temp(eventtime)
+        if temp - current_temp >= HEATUP_SAMPLE_MIN_RISE:
+            self._heatup_sampler.start(temp, eventtime)
 
     @property
     def active_to_standby_delay(self) -> float:
@@ -329,7 +764,7 @@ class KtcHeater:
                 + f" with klippy heater {self.klippy_heater.name}"
                 + f" and heater_active_temp {self.heater_active_temp}"
             )
-            self.klippy_heater.set_temp(self.heater_active_temp)
+            self.set_temp(self.heater_active_temp)
         elif value == HeaterStateType.STANDBY:
             if self._state != HeaterStateType.ACTIVE:
                 self.printer.lookup_object("ktc_log").trace(
@@ -365,7 +800,7 @@ class KtcHeater:
     def heater_active_temp(self, value):
         self._heater_active_temp = value if value > 0 else 0
         if self.state == HeaterStateType.ACTIVE:
-            self.klippy_heater.set_temp(self._heater_active_temp)
+            self.set_temp(self._heater_active_temp)
 
     @property
     def standby_temp(self):
@@ -378,7 +813,142 @@ class KtcHeater:
             self.state == HeaterStateType.STANDBY
             and not self.timer_heater_active_to_standby_delay.counting_down
         ):
-            self.klippy_heater.set_temp(self._standby_temp)
+            self.set_temp(self._standby_temp)
+
+
+class KtcHeaterScheduler:
+    """One reactor timer for all heater timers.
+
+    Deadlines are kept in a heap of (deadline, sequence, entry). Rescheduling
+    and canceling only mark the old heap item as stale, it is dropped when it
+    reaches the top. The reactor timer is only updated when the earliest
+    deadline moves earlier, a wake for a stale item just reschedules.
+    Entries must have a scheduled_event(eventtime) method."""
+
+    def __init__(self, printer: "klippy.Printer"):
+        self.reactor: "reactor.Reactor" = printer.get_reactor()
+        self._heap: list[tuple[float, int, typing.Any]] = []
+        # Sequence of the valid heap item for each scheduled entry.
+        self._scheduled: dict[typing.Any, tuple[float, int]] = {}
+        self._sequence = itertools.count()
+        self._timer_handler = None
+        self._next_wake = self.reactor.NEVER
+        # True while entries are run, the timer is updated when they are done.
+        self._dispatching = False
+        self.dispatched = 0
+        printer.register_event_handler("klippy:ready", self._handle_ready)
+
+    def _handle_ready(self):
+        self._next_wake = self._earliest_deadline()
+        self._timer_handler = self.reactor.register_timer(
+            self._timer_event, self._next_wake)
+
+    def schedule(self, entry, deadline: float):
+        """Schedule or reschedule the entry at the monotonic deadline."""
+        sequence = next(self._sequence)
+        self._scheduled[entry] = (deadline, sequence)
+        heapq.heappush(self._heap, (deadline, sequence, entry))
+        # Drop stale items when they are the majority.
+        if len(self._heap) > 2 * len(self._scheduled) + 16:
+            self._heap = [(d, q, e) for (d, q, e) in self._heap
+                          if self._scheduled.get(e) == (d, q)]
+            heapq.heapify(self._heap)
+        if (deadline < self._next_wake and self._timer_handler is not None
+                and not self._dispatching):
+            self._next_wake = deadline
+            self.reactor.update_timer(self._timer_handler, deadline)
+
+    def cancel(self, entry):
+        """Cancel the entry if scheduled."""
+        self._scheduled.pop(entry, None)
+
+    def deadline(self, entry) -> typing.Optional[float]:
+        """Return the monotonic deadline of the entry or None if not scheduled."""
+        scheduled = self._scheduled.get(entry)
+        return scheduled[0] if scheduled is not None else None
+
+    def _earliest_deadline(self) -> float:
+        heap = self._heap
+        while heap and self._scheduled.get(heap[0][2]) != heap[0][:2]:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else self.reactor.NEVER
+
+    def _timer_event(self, eventtime):
+        # Entries scheduled by the entries run here are in the heap when the
+        # next wake is taken from it below.
+        self._dispatching = True
+        try:
+            while self._earliest_deadline() <= eventtime:
+                _, _, entry = heapq.heappop(self._heap)
+                del self._scheduled[entry]
+                self.dispatched += 1
+                try:
+                    entry.scheduled_event(eventtime)
+                except Exception:   # pylint: disable=broad-except
+                    # Don't let one entry stop the timers of all heaters.
+                    logging.exception("KTC: Heater timer %s failed", entry)
+        finally:
+            self._dispatching = False
+        self._next_wake = self._earliest_deadline()
+        return self._next_wake
+
+    def get_status(self, eventtime=None):  # pylint: disable=unused-argument
+        return {
+            "timers_scheduled": len(self._scheduled),
+            "next_deadline": self._earliest_deadline(),
+            "dispatched": self.dispatched,
+        }
+
+
+class KtcPredictivePreheat:
+    """Preheat of the tool predicted to be selected next, run by the
+    KtcHeaterScheduler. Only heaters not active for another tool are heated,
+    the state of the tool itself is not changed. Keeps the state of each
+    heater before the preheat so a wrong prediction can be undone."""
+
+    def __init__(self, ktc: "ktc.Ktc", tool: "ktc_tool.KtcTool", heatup_time: float):
+        self.ktc = ktc
+        self.tool = tool
+        self.heatup_time = heatup_time
+        # State before the preheat of each heater set to active.
+        self.previous_states: dict[KtcHeater, HeaterStateType] = {}
+        # Reactor time the heaters were set to active, None until then.
+        self.started_at: typing.Optional[float] = None
+
+    def scheduled_event(self, eventtime):
+        tool = self.tool
+        ext = tool.extruder
+        if ext.state == HeaterStateType.ACTIVE:
+            return
+        ktc = self.ktc
+        with ktc.heater_batch():
+            for hs in ext.heaters:
+                heater = ktc.all_heaters[hs.name]
+                # A heater shared with the printing tool keeps its temperature.
+                if (heater.active_tools_count > 0
+                        or heater.state == HeaterStateType.ACTIVE):
+                    continue
+                self.previous_states[heater] = heater.state
+                heater.heater_active_temp = hs.temperature_offset + ext.active_temp
+                heater.state = HeaterStateType.ACTIVE
+        if self.previous_states:
+            self.started_at = eventtime
+            tool.log.debug(f"Predictive preheat of tool {tool.name}: "
+                           + f"{[heater.name for heater in self.previous_states]}.")
+
+    def seconds_saved(self, eventtime: float) -> float:
+        """Return the heating time done before the tool was selected."""
+        if self.started_at is None:
+            return 0.
+        return min(eventtime - self.started_at, self.heatup_time)
+
+    def undo(self):
+        """Return the preheated heaters not used by an active tool to the state
+        before the preheat."""
+        for heater, state in self.previous_states.items():
+            if (heater.state == HeaterStateType.ACTIVE
+                    and heater.active_tools_count == 0):
+                heater.state = state
 
 
 class KtcHeaterTimer:
@@ -392,29 +962,29 @@ class KtcHeaterTimer:
         self.timer_type = timer_type  # 0= Time to shutdown, 1= Time to standby.
 
         self.reactor: "reactor.Reactor" = self.printer.get_reactor()
-        self.gcode = typing.cast(
-            "gcode.GCodeDispatch", self.printer.lookup_object("gcode")
-        )
-        self.timer_handler = None
         self.inside_timer = self.repeat = False
-        self.printer.register_event_handler("klippy:ready", self.__handle_ready)
         self.log = typing.cast("ktc_log.KtcLog", self.printer.lookup_object("ktc_log"))
+        self._scheduler: typing.Optional[KtcHeaterScheduler] = None
 
         self.counting_down = False
         self.nextwake = self.reactor.NEVER
 
-    def __handle_ready(self):
-        self.timer_handler = self.reactor.register_timer(
-            self._temp_timer_event, self.reactor.NEVER
-        )
-
-    def _temp_timer_event(self, eventtime):
+    @property
+    def scheduler(self) -> KtcHeaterScheduler:
+        """The scheduler shared by all heater timers, owned by ktc."""
+        if self._scheduler is None:
+            self._scheduler = typing.cast(
+                "ktc.Ktc", self.printer.lookup_object("ktc")).heater_scheduler
+        return self._scheduler
+
+    def scheduled_event(self, eventtime):
         self.inside_timer = True
         self.counting_down = False
-        self.log.trace(
-            f"Running heater timer for {self.heater.name}: "
-            + f"{('Standby' if self.timer_type == HeaterTimerType.TIMER_TO_STANDBY else 'OFF')}"
-        )
+        if self.log.trace_enabled:
+            self.log.trace(
+                f"Running heater timer for {self.heater.name}: "
+                + f"{('Standby' if self.timer_type == HeaterTimerType.TIMER_TO_STANDBY else 'OFF')}"
+            )
 
         try:
             if self.timer_type == HeaterTimerType.TIMER_TO_STANDBY:
@@ -422,22 +992,24 @@ class KtcHeaterTimer:
                     self.heater
                 )
                 self.log.track_heater_active_end_for_tools_having_heater(self.heater)
-                self.heater.klippy_heater.set_temp(self.heater.standby_temp)
+                self.heater.set_temp(self.heater.standby_temp)
                 self.heater.timer_heater_active_to_standby_delay.set_timer(NEVER)
                 self.heater.timer_heater_standby_to_powerdown_delay.set_timer(
                     self.heater.standby_to_powerdown_delay
                 )
-                self.log.trace(
-                    f"Setting temperature to {self.heater.standby_temp} "
-                    + f"for heater {self.heater.name} "
-                )
+                if self.log.trace_enabled:
+                    self.log.trace(
+                        f"Setting temperature to {self.heater.standby_temp} "
+                        + f"for heater {self.heater.name} "
+                    )
             else:
-                self.heater.klippy_heater.set_temp(0)
+                self.heater.set_temp(0)
                 self.heater.timer_heater_active_to_standby_delay.set_timer(NEVER)
                 self.heater.timer_heater_standby_to_powerdown_delay.set_timer(NEVER)
-                self.log.trace(
-                    f"Setting temperature to 0 for heater {self.heater.name} "
-                )
+                if self.log.trace_enabled:
+                    self.log.trace(
+                        f"Setting temperature to 0 for heater {self.heater.name} "
+                    )
                 self.log.track_heater_end_for_tools_having_heater(self.heater)
 
         except Exception as e:
@@ -453,10 +1025,10 @@ class KtcHeaterTimer:
         if self.repeat:
             self.nextwake = eventtime + self.duration
             self.counting_down = True
+            self.scheduler.schedule(self, self.nextwake)
         else:
             self.nextwake = self.reactor.NEVER
         self.inside_timer = self.repeat = False
-        return self.nextwake
 
     def set_timer(self, duration: float):
         """Set the timer for the heater and the duration.
@@ -465,27 +1037,28 @@ class KtcHeaterTimer:
         if self.inside_timer:
             self.repeat = self.duration != 0.0
         else:
-            waketime = self.reactor.NEVER
-            if self.duration:
-                waketime = self.reactor.monotonic() + self.duration
-                self.nextwake = waketime
-            self.reactor.update_timer(self.timer_handler, waketime)
-            self.log.trace(
-                f"heatertimer set_timer {self.timer_type}: "
-                + f"duration: {self.duration}, "
-                + f"nextwake: {self._time_left()} "
-                f"counting_down: {self.counting_down}"
-            )
             if self.duration:
+                self.nextwake = self.reactor.monotonic() + self.duration
+                self.scheduler.schedule(self, self.nextwake)
                 self.counting_down = True
             else:
+                self.nextwake = self.reactor.NEVER
+                self.scheduler.cancel(self)
                 self.counting_down = False
+            if self.log.trace_enabled:
+                self.log.trace(
+                    f"heatertimer set_timer {self.timer_type}: "
+                    + f"duration: {self.duration}, "
+                    + f"nextwake: {self._time_left()} "
+                    f"counting_down: {self.counting_down}"
+                )
 
-        self.log.trace(
-            f"Time until heater {str(self.heater.name)} "
-            + f"changes to {('Standby' if self.timer_type == 1 else 'OFF')}: "
-            + f"{self._time_left()}"
-        )
+        if self.log.trace_enabled:
+            self.log.trace(
+                f"Time until heater {str(self.heater.name)} "
+                + f"changes to {('Standby' if self.timer_type == 1 else 'OFF')}: "
+                + f"{self._time_left()}"
+            )
 
     def get_status(self, eventtime=None):  # pylint: disable=unused-argument
         status = {
@@ -493,6 +1066,8 @@ class KtcHeaterTimer:
             "duration": self.duration,
             "counting_down": self.counting_down,
             "next_wake": self._time_left(),
+            # Absolute reactor.monotonic() time of the timer or None.
+            "deadline": self.scheduler.deadline(self),
         }
         return status
 
@@ -20,6 +20,13 @@ if typing.TYPE_CHECKING:
     from ...klipper.klippy import klippy
     from . import ktc_toolchanger, ktc_tool, ktc_persisting, ktc, ktc_heater
 
+# Name of the persisted variable holding the transition matrix.
+TRANSITION_MATRIX_VARIABLE = "transition_matrix"
+# Names of the persisted variables holding the next tool model and its hit rate.
+NEXT_TOOL_MODEL_VARIABLE = "next_tool_model"
+NEXT_TOOL_PREDICTIONS_VARIABLE = "next_tool_predictions"
+# Changes from a tool needed before predicting the next tool.
+NEXT_TOOL_MIN_CHANGES = 3
 LINE_SEPARATOR = "\n--------------------------------------------------------\n"
 SECTION_SEPARATOR = (
     "\n========================================================\n"
@@ -59,6 +66,9 @@ class KtcLog:
             "logfile_level", default=3,  #type: ignore # Klippy is not type checked.
             minval=-1, maxval=4)
 
+        # Set at connect.
+        self._ktc_persistent: typing.Optional['ktc_persisting.KtcPersisting'] = None
+
         # Initialize Logger variable
         self._ktc_logger = None
 
@@ -90,6 +100,20 @@ class KtcLog:
         self.tool_stats: typing.Dict[str, ToolStatisticsClass] = {}
         self.print_changer_stats: typing.Dict[str, ChangerStatisticsClass] = {}
         self.print_tool_stats: typing.Dict[str, ToolStatisticsClass] = {}
+        # Statistics for each change from one tool to another, keyed by the tool names.
+        self.transition_stats: typing.Dict[
+            typing.Tuple[str, str], TransitionStatisticsClass] = {}
+        self._transition_matrix_status: typing.Optional[dict] = None
+        # Markov model of the next tool: changes from one tool to the next,
+        # keyed by the tool names, and the time spent before each change.
+        self.next_tool_stats: typing.Dict[
+            typing.Tuple[str, str], NextToolStatisticsClass] = {}
+        self.prediction_stats = PredictionStatisticsClass()
+        # Name of the last tool changed to and the reactor time of the change.
+        self._last_change: typing.Optional[typing.Tuple[str, float]] = None
+        # Set when the model changed and is saved at the next save of ktc_persisting.
+        self._transitions_changed = False
+        self._next_tool_model_changed = False
 
     def _handle_connect(self):
         '''Handle the connect event. This is called when the printer connects to Klipper.'''
@@ -98,6 +122,8 @@ class KtcLog:
         # Load the persistent variables object here to avoid circular dependencies
         self._ktc_persistent = typing.cast(      # pylint: disable=attribute-defined-outside-init
             'ktc_persisting.KtcPersisting', self.printer.lookup_object( "ktc_persisting"))
+        # The models change at every toolchange, save them with the batched saves.
+        self._ktc_persistent.register_save_callback(self._persist_changed_models)
 
         # Register G-code commands
         handlers = [
@@ -110,6 +136,8 @@ class KtcLog:
             "KTC_RESET_STATS",
             "KTC_RESET_PRINT_STATS",
             "KTC_PRINT_STATS_REPORT",
+            "KTC_TRANSITION_MATRIX",
+            "KTC_NEXT_TOOL_MODEL",
         ]
         for cmd in handlers:
             func = getattr(self, "cmd_" + cmd)
@@ -131,8 +159,6 @@ class KtcLog:
         self.always("Klipper disconnected! Closing KTC log.")
         if self.queue_listener:
             self.queue_listener.stop()
-        if self._ktc_persistent is not None:
-            self._ktc_persistent.disconnect()  # Close the persistent variables file
 
     ####################################
     # LOGGING METHODS                  #
@@ -160,6 +186,12 @@ class KtcLog:
         if self.log_level > 1:
             self.gcode.respond_info(message)
 
+    @property
+    def trace_enabled(self) -> bool:
+        """True if trace messages are logged anywhere. Used to skip formatting
+        trace messages in frequently called code."""
+        return self.log_level > 2 or bool(self._ktc_logger and self.logfile_level > 2)
+
     def trace(self, message):
         """Log a trace message to the console and to the log file if enabled and 
         log_level is 3 or higher."""
@@ -187,6 +219,41 @@ class KtcLog:
         self.tool_stats = self._get_persisted_items(
             "Statistics", "ktc_tool", ToolStatisticsClass
         )
+        self.transition_stats = self._get_persisted_transitions()
+        self._transition_matrix_status = None
+        self._get_persisted_next_tool_model()
+
+    def _get_persisted_next_tool_model(self):
+        """Load the next tool model, saved as {(from tool, to tool): [count, dwell], ...},
+        and the prediction statistics, saved as [predictions, hits, seconds_saved]."""
+        statistics: dict = self._ktc_persistent.content.get("Statistics", {})
+        try:
+            self.next_tool_stats = {
+                (str(from_tool), str(to_tool)): NextToolStatisticsClass(
+                    int(count), float(dwell))
+                for (from_tool, to_tool), (count, dwell) in statistics.get(
+                    NEXT_TOOL_MODEL_VARIABLE, {}).items()}
+            self.prediction_stats = PredictionStatisticsClass(
+                *statistics.get(NEXT_TOOL_PREDICTIONS_VARIABLE, []))
+        except Exception as e:
+            self.debug("Error while loading the next tool model: %s. Resetting it." % e)
+            self.next_tool_stats = {}
+            self.prediction_stats = PredictionStatisticsClass()
+
+    def _get_persisted_transitions(self):
+        """Load the transition matrix, saved as
+        {(from tool, to tool): [count, mean, max], ...}."""
+        transitions: typing.Dict[typing.Tuple[str, str], TransitionStatisticsClass] = {}
+        loaded: dict = self._ktc_persistent.content.get("Statistics", {}).get(
+            TRANSITION_MATRIX_VARIABLE, {})
+        try:
+            for (from_tool, to_tool), (count, mean, maximum) in loaded.items():
+                transitions[(str(from_tool), str(to_tool))] = TransitionStatisticsClass(
+                    int(count), float(mean), float(maximum))
+        except Exception as e:
+            self.debug("Error while loading the transition matrix: %s. Resetting it." % e)
+            transitions = {}
+        return transitions
 
     def _get_persisted_items(
         self, section: str, module_name: str, stat_type : type[typing.Any]
@@ -244,6 +311,36 @@ class KtcLog:
                 % e
             )
 
+    def _persist_changed_models(self):
+        """Save the transition matrix and the next tool model if they changed.
+        Called by ktc_persisting before it saves."""
+        if self._transitions_changed:
+            self._persist_transitions()
+        if self._next_tool_model_changed:
+            self._persist_next_tool_model()
+
+    def _persist_transitions(self):
+        """Save the transition matrix in a compact form."""
+        self._transitions_changed = False
+        self._ktc_persistent.save_variable(
+            TRANSITION_MATRIX_VARIABLE,
+            str({k: [v.count, round(v.mean, 2), round(v.max, 2)]
+                 for k, v in self.transition_stats.items()}),
+            section="Statistics")
+
+    def _persist_next_tool_model(self):
+        """Save the next tool model and the prediction statistics in a compact form."""
+        self._next_tool_model_changed = False
+        self._ktc_persistent.save_variable(
+            NEXT_TOOL_MODEL_VARIABLE,
+            str({k: [v.count, round(v.dwell, 2)] for k, v in self.next_tool_stats.items()}),
+            section="Statistics")
+        p = self.prediction_stats
+        self._ktc_persistent.save_variable(
+            NEXT_TOOL_PREDICTIONS_VARIABLE,
+            str([p.predictions, p.hits, round(p.seconds_saved, 2)]),
+            section="Statistics")
+
     def _set_persisted_items(
         self,
         section: str,
@@ -291,6 +388,13 @@ class KtcLog:
         for tool in self.printer.lookup_objects("ktc_tool"):
             self.tool_stats[str(tool[0]).split(" ", 1)[1]] = ToolStatisticsClass()
 
+        self.transition_stats = {}
+        self._transition_matrix_status = None
+        self.next_tool_stats = {}
+        self.prediction_stats = PredictionStatisticsClass()
+        self._transitions_changed = True
+        self._next_tool_model_changed = True
+
     def _reset_print_statistics(self):
         """Reset all the print statistics to same as regular statistics.
         This is called at the start of each print to reset the print statistics.
@@ -537,6 +641,12 @@ class KtcLog:
                 )
             )
 
+        ##############################  Elided toolchanges
+        # 12 toolchanges elided.
+        if t.toolchanges_elided > 0:
+            result += "\n%s toolchanges elided." % (
+                KtcLog.bignumber_to_human_string(t.toolchanges_elided))
+
         ##############################  Active times
         # 1:00:00 with heater active and 1:00:00 with heater in standby.
         if t.time_heater_active > 0 or t.time_heater_standby > 0:
@@ -576,6 +686,64 @@ class KtcLog:
         self.tool_stats[tool.name].selects_completed += 1
         self._persist_statistics()
 
+    def track_tool_toolchange_elided(self, tool: 'ktc_tool.KtcTool'):
+        self.tool_stats[tool.name].toolchanges_elided += 1
+        self._persist_statistics()
+
+    def track_tool_transition(self, from_tool: 'ktc_tool.KtcTool',
+                              to_tool: 'ktc_tool.KtcTool', seconds: float):
+        """Add the duration of a full change from one tool to another."""
+        key = (from_tool.name, to_tool.name)
+        if key not in self.transition_stats:
+            self.transition_stats[key] = TransitionStatisticsClass()
+        self.transition_stats[key].add(seconds)
+        self._transition_matrix_status = None
+        self._transitions_changed = True
+
+    def transition_matrix_status(self) -> typing.Dict[str, typing.Dict[str, dict]]:
+        """Return the transition matrix as {from: {to: {count, mean, max}}}.
+        Rebuilt only after a transition is added, it is read on every status poll."""
+        if self._transition_matrix_status is None:
+            matrix: typing.Dict[str, typing.Dict[str, dict]] = {}
+            for (from_tool, to_tool), t in self.transition_stats.items():
+                matrix.setdefault(from_tool, {})[to_tool] = dataclasses.asdict(t)
+            self._transition_matrix_status = matrix
+        return self._transition_matrix_status
+
+    def track_next_tool(self, to_tool: 'ktc_tool.KtcTool', eventtime: float):
+        """Add a change to the next tool model, from the last tool changed to.
+        The dwell is the time from the last change to this change."""
+        if self._last_change is not None:
+            from_name, last_eventtime = self._last_change
+            key = (from_name, to_tool.name)
+            if key not in self.next_tool_stats:
+                self.next_tool_stats[key] = NextToolStatisticsClass()
+            self.next_tool_stats[key].add(eventtime - last_eventtime)
+            self._next_tool_model_changed = True
+        self._last_change = (to_tool.name, eventtime)
+
+    def predict_next_tool(self, from_tool: 'ktc_tool.KtcTool'
+                          ) -> typing.Optional[typing.Tuple[str, float, float]]:
+        """Return the most likely next tool name after from_tool, its probability
+        and the mean time before changing to it. None if from_tool has fewer than
+        NEXT_TOOL_MIN_CHANGES recorded changes."""
+        candidates = [(v.count, to_name, v.dwell)
+                      for (from_name, to_name), v in self.next_tool_stats.items()
+                      if from_name == from_tool.name and to_name != from_tool.name]
+        total = sum(c[0] for c in candidates)
+        if total < NEXT_TOOL_MIN_CHANGES:
+            return None
+        count, to_name, dwell = max(candidates)
+        return to_name, count / total, dwell
+
+    def track_prediction(self, hit: bool, seconds_saved: float):
+        """Add the outcome of a predictive preheat."""
+        self.prediction_stats.predictions += 1
+        if hit:
+            self.prediction_stats.hits += 1
+            self.prediction_stats.seconds_saved += seconds_saved
+        self._next_tool_model_changed = True
+
     def track_tool_deselecting_start(self, tool: 'ktc_tool.KtcTool'):
         self.tool_stats[tool.name].start_time_spent_deselecting = int(time.time())
         self.tool_stats[tool.name].deselects_started += 1
@@ -612,83 +780,51 @@ class KtcLog:
             f"track_heater_active_start: Tool: {tool.name}")
 
     def track_heater_active_end_for_tools_having_heater(self, heater: 'ktc_heater.KtcHeater'):
-        for tool in self._ktc.all_tools.values():
-            if tool not in self._ktc.INVALID_TOOLS:
-                # self.debug(
-                #     "track_heater_active_end_for_tools_having_heater: "
-                #     + f"Heater: {heater.name}: Tool: {tool.name} .start_time_heater_active: "
-                #     + f"{self.tool_stats[tool.name].start_time_heater_active}")
-                if self.tool_stats[tool.name].start_time_heater_active:
-                    # self.debug(
-                    #     "track_heater_active_end_for_tools_having_heater: "
-                    #     + f"Tool: {tool.name}: Is in Active mode."
-                    #     + f" Will check if heater: {heater.name} is in heater_names: "
-                    #     + f"{tool.extruder.heater_names()}")
-
-                    if heater.name in tool.extruder.heater_names():
-                        self.debug(
-                            "track_heater_active_end_for_tools_having_heater: "
-                            + f"Heater: {heater.name}: Active end called for tool: {tool.name}")
-                        self.track_heater_active_end(tool)
+        for tool in heater.tools:
+            if self.tool_stats[tool.name].start_time_heater_active:
+                self.debug(
+                    "track_heater_active_end_for_tools_having_heater: "
+                    + f"Heater: {heater.name}: Active end called for tool: {tool.name}")
+                self.track_heater_active_end(tool)
 
     def track_heater_active_end_for_other_tools(self, tool_still_active: 'ktc_tool.KtcTool'):
         '''Called when a tool changes state to active. 
         Will call active end for all other tools having any of the same heaters and
         having running active timers.'''
-        invalid_tools = (tool_still_active, self._ktc.TOOL_NONE, self._ktc.TOOL_UNKNOWN, None)
-        for tool in tool_still_active._ktc.all_tools.values():  # pylint: disable=protected-access
-            if tool not in invalid_tools:
-                if self.tool_stats[tool.name].start_time_heater_active:
-                    for heater_name in tool.extruder.heater_names():
-                        if heater_name in tool_still_active.extruder.heater_names():
-                            self.debug(
-                                "track_heater_active_end_for_other_tools: "
-                                + f"Tool: {tool_still_active.name}: "
-                                + f"Active end called for tool: {tool.name}")
-                            self.track_heater_active_end(tool)
+        for hs in tool_still_active.extruder.heaters:
+            for tool in self._ktc.all_heaters[hs.name].tools:
+                if (tool is not tool_still_active
+                    and self.tool_stats[tool.name].start_time_heater_active):
+                    self.debug(
+                        "track_heater_active_end_for_other_tools: "
+                        + f"Tool: {tool_still_active.name}: "
+                        + f"Active end called for tool: {tool.name}")
+                    self.track_heater_active_end(tool)
 
     def track_heater_standby_start_for_standby_tools_having_heater(
         self, heater: 'ktc_heater.KtcHeater'):
         '''Called by the HeaterTimer when the heater is set to standby.'''
-        for tool in self._ktc.all_tools.values():
-            if tool not in self._ktc.INVALID_TOOLS:
-                # self.debug(
-                #     "track_heater_standby_start_for_standby_tools_having_heater: "
-                #     + f"Tool: {tool.name} .extruder.state: {tool.extruder.state}")
-                if tool.extruder.state == 1:
-                    # self.debug(
-                    #     "track_heater_standby_start_for_standby_tools_having_heater: "
-                    #     + f"Tool: {tool.name}: Is in Standby mode."
-                    #     + f" Will check if heater: {heater.name} is in heater_names: "
-                    #     + f"{tool.extruder.heater_names()}")
-                    if heater.name in tool.extruder.heater_names():
-                        self.debug(
-                            "track_heater_standby_start_for_standby_tools_having_heater: "
-                            + f"Heater {heater.name} is in tool: {tool.name}")
-                        self.track_heater_standby_start(tool)
-                        # self.debug(
-                        #     "track_heater_standby_start_for_standby_tools_having_heater: "
-                        #     + f"Tool: {tool.name}: Standby start called for tool: {tool.name}")
+        for tool in heater.tools:
+            if tool.extruder.state == 1:
+                self.debug(
+                    "track_heater_standby_start_for_standby_tools_having_heater: "
+                    + f"Heater {heater.name} is in tool: {tool.name}")
+                self.track_heater_standby_start(tool)
 
     def track_heater_end_for_tools_having_heater(self, heater: 'ktc_heater.KtcHeater'):
         '''Called by the HeaterTimer when the heater is set to off.'''
-        for tool in self._ktc.all_tools.values():
-            if tool not in self._ktc.INVALID_TOOLS:
-                if self.tool_stats[tool.name].start_time_heater_standby:
-                    if heater.name in tool.extruder.heater_names():
-                        if self.tool_stats[tool.name].start_time_heater_standby:
-                            self.debug(
-                                "track_heater_end_for_tools_having_heater: "
-                                + f"Heater: {heater.name}: Standby end called "
-                                + "for tool: {tool.name}")
-                            self.track_heater_standby_end(tool)
-                if self.tool_stats[tool.name].start_time_heater_active:
-                    if heater.name in tool.extruder.heater_names():
-                        if self.tool_stats[tool.name].start_time_heater_active:
-                            self.debug(
-                                "track_heater_end_for_tools_having_heater: "
-                                + f"Heater: {heater.name}: Active end called for tool: {tool.name}")
-                            self.track_heater_active_end(tool)
+        for tool in heater.tools:
+            if self.tool_stats[tool.name].start_time_heater_standby:
+                self.debug(
+                    "track_heater_end_for_tools_having_heater: "
+                    + f"Heater: {heater.name}: Standby end called "
+                    + f"for tool: {tool.name}")
+                self.track_heater_standby_end(tool)
+            if self.tool_stats[tool.name].start_time_heater_active:
+                self.debug(
+                    "track_heater_end_for_tools_having_heater: "
+                    + f"Heater: {heater.name}: Active end called for tool: {tool.name}")
+                self.track_heater_active_end(tool)
 
     def track_heater_active_end(self, tool: 'ktc_tool.KtcTool'):
         self.debug(
@@ -798,6 +934,55 @@ class KtcLog:
     def cmd_KTC_PRINT_STATS_REPORT(self, gcmd):   # pylint: disable=unused-argument
         self._dump_statistics(since_print_start=True)
 
+    cmd_KTC_TRANSITION_MATRIX_help = ("[RESET=1] Report the measured time of "
+                                      + "changes between each pair of tools.")
+    def cmd_KTC_TRANSITION_MATRIX(self, gcmd):
+        if gcmd.get_int("RESET", 0, minval=0, maxval=1):
+            self.transition_stats = {}
+            self._transition_matrix_status = None
+            self._persist_transitions()
+            self.always("KTC transition matrix RESET.")
+            return
+        if not self.transition_stats:
+            self.always("KTC transition matrix is empty.")
+            return
+        msg = "KTC transition matrix:\n"
+        for from_tool in natural_keys_sorting({k[0] for k in self.transition_stats}):
+            for to_tool in natural_keys_sorting(
+                {k[1] for k in self.transition_stats if k[0] == from_tool}):
+                t = self.transition_stats[(from_tool, to_tool)]
+                msg += "%s -> %s: %s changes, avg. %.1fs, max %.1fs.\n" % (
+                    from_tool, to_tool, KtcLog.bignumber_to_human_string(t.count),
+                    t.mean, t.max)
+        self.always(msg.rstrip("\n"))
+
+    cmd_KTC_NEXT_TOOL_MODEL_help = ("[RESET=1] Report the learned next tool model and "
+                                    + "the predictive preheat hit rate.")
+    def cmd_KTC_NEXT_TOOL_MODEL(self, gcmd):
+        if gcmd.get_int("RESET", 0, minval=0, maxval=1):
+            self.next_tool_stats = {}
+            self.prediction_stats = PredictionStatisticsClass()
+            self._persist_next_tool_model()
+            self.always("KTC next tool model RESET.")
+            return
+        p = self.prediction_stats
+        msg = "KTC next tool model:\n"
+        for from_tool in natural_keys_sorting({k[0] for k in self.next_tool_stats}):
+            total = sum(v.count for k, v in self.next_tool_stats.items()
+                        if k[0] == from_tool)
+            for to_tool in natural_keys_sorting(
+                {k[1] for k in self.next_tool_stats if k[0] == from_tool}):
+                t = self.next_tool_stats[(from_tool, to_tool)]
+                msg += "%s -> %s: %.0f%% of %s changes, after avg. %s.\n" % (
+                    from_tool, to_tool, t.count / total * 100,
+                    KtcLog.bignumber_to_human_string(total),
+                    KtcLog.seconds_to_human_string(t.dwell))
+        msg += "%s predictive preheats, %.1f%% hits, %s of waiting saved." % (
+            KtcLog.bignumber_to_human_string(p.predictions),
+            safe_division(p.hits, p.predictions) * 100,
+            KtcLog.seconds_to_human_string(p.seconds_saved))
+        self.always(msg)
+
     cmd_KTC_SET_LOG_LEVEL_help = "Set the log level for the KTC"
     def cmd_KTC_SET_LOG_LEVEL(self, gcmd):
         self.log_level = gcmd.get_int("LEVEL", self.log_level, minval=0, maxval=4)
@@ -908,6 +1093,7 @@ class ToolStatisticsClass(StatisticsBaseClass):
     time_heater_standby: int = 0
     time_spent_selecting: int = 0
     time_spent_deselecting: int = 0
+    toolchanges_elided: int = 0
     start_time_selected: int = 0  # TRACKED_START_TIME_SELECTED
     start_time_heater_active: int = 0  # TRACKED_START_TIME_ACTIVE
     start_time_heater_standby: int = 0  # TRACKED_START_time_heater_standby
@@ -916,6 +1102,41 @@ class ToolStatisticsClass(StatisticsBaseClass):
 
 
 
+@dataclasses.dataclass
+class TransitionStatisticsClass:
+    """Statistics for changes from one tool to another."""
+
+    count: int = 0
+    mean: float = 0.
+    max: float = 0.
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.mean += (seconds - self.mean) / self.count
+        self.max = max(self.max, seconds)
+
+
+@dataclasses.dataclass
+class NextToolStatisticsClass:
+    """Changes from one tool to the next and the mean time before the change."""
+
+    count: int = 0
+    dwell: float = 0.
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.dwell += (seconds - self.dwell) / self.count
+
+
+@dataclasses.dataclass
+class PredictionStatisticsClass:
+    """Outcome of predictive preheats."""
+
+    predictions: int = 0
+    hits: int = 0
+    seconds_saved: float = 0.
+
+
 ####################################
 # MultiLineFormater                #
 ####################################
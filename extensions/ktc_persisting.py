@@ -14,8 +14,13 @@
 #
 # This module will also only save the variables when needed and no more.
 # This is to avoid excessive writes to the SD card and overhaed on the system.
+# Changed variables are appended to a journal file next to the variables file.
+# The journal is compacted into the variables file when it grows too large.
+# Files are written by a background thread so a slow SD card does not stall
+# the reactor. The variables file is replaced atomically.
 
-import os.path, ast, configparser, typing
+import os, os.path, ast, configparser, typing
+import io, threading, queue, time
 
 # Only import these modules in Dev environment. Consult Dev_doc.md for more info.
 if typing.TYPE_CHECKING:
@@ -26,6 +31,9 @@ if typing.TYPE_CHECKING:
 # Constant values moved here to avoid circular imports
 KTC_SAVE_VARIABLES_FILENAME = "~/ktc_variables.cfg"
 KTC_SAVE_VARIABLES_DELAY = 10
+KTC_SAVE_VARIABLES_JOURNAL_SUFFIX = ".journal"
+# Journal size in bytes at which it is compacted into the variables file.
+KTC_SAVE_VARIABLES_JOURNAL_MAX_SIZE = 64 * 1024
 
 class KtcPersisting:
     def __init__(self, config: 'configfile.ConfigWrapper'):
@@ -36,9 +44,37 @@ class KtcPersisting:
         ))
 
         self.filename = os.path.expanduser(KTC_SAVE_VARIABLES_FILENAME)
+        self.journal_filename = self.filename + KTC_SAVE_VARIABLES_JOURNAL_SUFFIX
+        self.journal_size = 0
 
         self.content = {}
         self.ready_to_save = False
+        # Variables changed since the last save as (section, name): value.
+        self._changed: dict[tuple[str, str], typing.Any] = {}
+        # Called before each save to save variables changing too often to
+        # be saved at each change.
+        self._save_callbacks: list[typing.Callable[[], None]] = []
+
+        # Write latency in seconds, measured by the writer thread. The writer
+        # thread changes these and the reactor reads them, under _stats_lock.
+        self._stats_lock = threading.Lock()
+        self.write_count = 0
+        self.write_time_last = 0.
+        self.write_time_max = 0.
+        self.write_time_total = 0.
+        self.write_errors = 0
+        self._write_errors_logged = 0
+        self._last_write_error = ""
+        # Set by the writer thread when writing the variables file failed,
+        # the next save compacts again.
+        self._compact_failed = False
+        # Writes as (method, text), done in order by the writer thread.
+        self._write_queue: queue.Queue = queue.Queue()
+        # Daemon so a thread left running when startup fails does not keep
+        # Klipper from exiting. It is joined at disconnect.
+        self._writer_thread = threading.Thread(target=self._writer, daemon=True)
+        self._disconnected = False
+        self.printer.register_event_handler("klippy:disconnect", self.disconnect)
 
         # Set up timer to only save values when needed
         # and no more than once every 10 seconds to allow for
@@ -54,10 +90,24 @@ class KtcPersisting:
             self.load_content()
         except Exception as e:
             raise e.with_traceback(e.__traceback__)
+        # Started when loaded so a failed load leaves no thread running.
+        self._writer_thread.start()
 
-    # Remove the timer when Klipper shuts down
+    # Remove the timer and write unsaved changes when Klipper shuts down
     def disconnect(self):
+        if self._disconnected:
+            return
+        self._disconnected = True
         self.reactor.update_timer(self.timer_save, self.reactor.NEVER)
+        if not self._writer_thread.is_alive():
+            return
+        self._save_changes_timer_event(self.reactor.monotonic())
+        self._write_queue.put_nowait(None)
+        self._writer_thread.join()
+
+    def register_save_callback(self, callback: typing.Callable[[], None]):
+        """Register a callback run before each save, that can save variables."""
+        self._save_callbacks.append(callback)
 
     def load_content(self):
         sections = {}
@@ -73,6 +123,25 @@ class KtcPersisting:
             msg = "Unable to parse existing KTC variable file: %s" % (self.filename,)
             raise Exception(msg) from e
         self.content = sections
+        self._replay_journal()
+
+    def _replay_journal(self):
+        """Apply the changes in the journal on top of the variables file."""
+        if not os.path.exists(self.journal_filename):
+            return
+        with open(self.journal_filename, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    section, name, value = ast.literal_eval(line)
+                except (ValueError, SyntaxError) as e:
+                    # A line cut short by a power loss, the rest is not written.
+                    self.log.debug("KtcPersisting: Ignoring journal line %r: %s"
+                                   % (line, str(e)))
+                    # Don't append after the broken line.
+                    self._compact()
+                    return
+                self.content.setdefault(section, {})[name] = value
+        self.journal_size = os.path.getsize(self.journal_filename)
 
     def save_variable(self, varname: str, value: str, section: str = "Variables",
                       force_save: bool = False):
@@ -85,6 +154,7 @@ class KtcPersisting:
             self.content[section] = {}
 
         self.content[section][varname] = value
+        self._changed[(section, varname)] = value
         self.ready_to_save = True
 
         if force_save:
@@ -96,29 +166,125 @@ class KtcPersisting:
 
     def _save_changes_timer_event(self, eventtime):
         try:
+            with self._stats_lock:
+                write_errors, last_write_error = self.write_errors, self._last_write_error
+                compact_failed, self._compact_failed = self._compact_failed, False
+            if write_errors > self._write_errors_logged:
+                self._write_errors_logged = write_errors
+                self.log.always("KtcPersisting: Failed to save variables: %s"
+                                % last_write_error)
+            if compact_failed:
+                # The journal is still complete, retry to keep it from growing.
+                self.journal_size = max(self.journal_size,
+                                        KTC_SAVE_VARIABLES_JOURNAL_MAX_SIZE)
+                self.ready_to_save = True
+            for callback in self._save_callbacks:
+                callback()
             if self.ready_to_save:
                 self.ready_to_save = False
-
-                # Write file
-                varfile = configparser.ConfigParser()
-                for section, variables in sorted(self.content.items()):
-                    varfile.add_section(section)
-                    for name, val in sorted(variables.items()):
-                        varfile.set(section, name, repr(val))
-
-                f = open(self.filename, "w", encoding="utf-8")
-                varfile.write(f)
-                f.close()
+                if self.journal_size >= KTC_SAVE_VARIABLES_JOURNAL_MAX_SIZE:
+                    self._compact()
+                else:
+                    self._append_journal()
+                self._changed = {}
         except Exception as e:
             self.log.debug("_save_changes_timer_event:Exception: %s" % (str(e)))
             raise e.with_traceback(e.__traceback__)
         nextwake = eventtime + KTC_SAVE_VARIABLES_DELAY
         return nextwake
 
+    def _append_journal(self):
+        """Queue the changed variables to be appended to the journal, one line each."""
+        data = "".join(repr((section, name, value)) + "\n"
+                       for (section, name), value in self._changed.items())
+        self._write_queue.put_nowait((self._write_journal, data))
+        self.journal_size += len(data.encode("utf-8"))
+
+    def _compact(self):
+        """Queue all variables to be written to the variables file and the
+        journal to be emptied. The changed variables are appended to the journal
+        first, so after a crash between the two, the journal ends with the
+        values in the new file and replaying it gives the same content."""
+        if self._changed:
+            self._append_journal()
+        varfile = configparser.ConfigParser()
+        for section, variables in sorted(self.content.items()):
+            varfile.add_section(section)
+            for name, val in sorted(variables.items()):
+                varfile.set(section, name, repr(val))
+
+        # The text is final here, later changes to content don't affect the write.
+        text = io.StringIO()
+        varfile.write(text)
+        self._write_queue.put_nowait((self._write_snapshot, text.getvalue()))
+        self.journal_size = 0
+
+    ####################################
+    # Writer thread                    #
+    ####################################
+    def _writer(self):
+        while True:
+            job = self._write_queue.get(True)
+            if job is None:
+                break
+            write, text = job
+            start = time.monotonic()
+            try:
+                write(text)
+            except Exception as e:  # pylint: disable=broad-except
+                # Reported and retried by the save timer in the reactor thread.
+                with self._stats_lock:
+                    self._last_write_error = str(e)
+                    self.write_errors += 1
+                    if write == self._write_snapshot:
+                        self._compact_failed = True
+                continue
+            duration = time.monotonic() - start
+            with self._stats_lock:
+                self.write_count += 1
+                self.write_time_last = duration
+                self.write_time_max = max(self.write_time_max, duration)
+                self.write_time_total += duration
+
+    def _write_journal(self, data: str):
+        with open(self.journal_filename, "a", encoding="utf-8") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _write_snapshot(self, text: str):
+        # Write to a temporary file and rename it over the old one so a power loss
+        # leaves either the old or the new file.
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self.filename)
+        dir_fd = os.open(os.path.dirname(self.filename), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        self._truncate_journal()
+
+    def _truncate_journal(self):
+        # The journal is in the new file now.
+        with open(self.journal_filename, "w", encoding="utf-8") as f:
+            os.fsync(f.fileno())
+
     def get_status(self, eventtime=None):   # pylint: disable=unused-argument
-        status = {
-            "content": self.content,
-        }
+        with self._stats_lock:
+            status = {
+                "content": self.content,
+                "journal_size": self.journal_size,
+                "write_count": self.write_count,
+                "write_errors": self.write_errors,
+                "write_time_last": self.write_time_last,
+                "write_time_max": self.write_time_max,
+                "write_time_avg": (self.write_time_total / self.write_count
+                                   if self.write_count else 0.),
+            }
         return status
 
 
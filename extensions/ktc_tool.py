@@ -13,6 +13,7 @@ from .ktc_base import (     # pylint: disable=relative-beyond-top-level
     KtcBaseChangerClass,
 )
 from .ktc_heater import HeaterStateType, KtcHeaterSettings   # pylint: disable=relative-beyond-top-level
+from .ktc_tree import ToolchangeActionType    # pylint: disable=relative-beyond-top-level
 
 # Only import these modules in Dev environment. Consult Dev_doc.md for more info.
 if typing.TYPE_CHECKING:
@@ -72,6 +73,12 @@ class KtcTool(KtcBaseToolClass, KtcConstantsClass):
 
         self.extruder.active_to_standby_delay = self._heater_active_to_standby_delay_in_config
         self.extruder.standby_to_powerdown_delay = self._heater_standby_to_powerdown_delay_in_config
+        self.extruder.adaptive_standby_delay = self._heater_adaptive_standby_delay_in_config
+        self.extruder.adaptive_standby_delay_min = (
+            self._heater_adaptive_standby_delay_min_in_config)
+        self.extruder.adaptive_standby_delay_max = max(
+            self._heater_adaptive_standby_delay_max_in_config,
+            self._heater_adaptive_standby_delay_min_in_config)
         # Settings for any heaters.
         if self._heaters_config is not None:
             heaters = self._heaters_config.replace(" ", "").split(",")
@@ -86,14 +93,19 @@ class KtcTool(KtcBaseToolClass, KtcConstantsClass):
                         self.printer.load_object(
                         self.config, "ktc_heater " + heater_settings.name)
                     )
+                self._ktc.all_heaters[heater_settings.name].tools.append(self)
 
+        self._build_gcode_template_cache()
         self.state = self.StateType.CONFIGURED
 
     def cmd_SelectTool(self, gcmd): # pylint: disable=invalid-name, unused-argument
         self.log.trace("KTC Tool " + str(self.number) + " Selected.")
+        if self._ktc.request_toolchange(self):
+            return
         self.run_with_profile(self.select, final_selected=True)
 
     def select(self, final_selected=False):
+        previous_state = self.state
         self.state = self.StateType.SELECTING
         try:
             self.log.always("KTC Tool %s Selecting." % self.name)
@@ -106,6 +118,7 @@ class KtcTool(KtcBaseToolClass, KtcConstantsClass):
             if final_selected:
                 # If already selected as final tool then do nothing.
                 if self == at:
+                    self.state = previous_state
                     return
 
                 if at == self.TOOL_UNKNOWN:
@@ -115,43 +128,52 @@ class KtcTool(KtcBaseToolClass, KtcConstantsClass):
                     self.log.always(msg)
                     raise self.printer.command_error(msg)
 
-                # If the new tool to be selected has any heaters prepare warmup before
-                # actual tool change so all moves will be done while heating up.
-                if len(self.extruder.heaters) > 0:
-                    self.set_heaters(heater_state=HeaterStateType.ACTIVE)
-
-                # Put all other active heaters in standby.
-                for heater in ( heater for heater in self._ktc.all_heaters.values()
-                                if heater.state == HeaterStateType.ACTIVE
-                                and heater.name not in self.extruder.heater_names()):
-                    heater.state = HeaterStateType.STANDBY
-
-                # If another tool is selected it needs to be deselected first.
-                if at is not self.TOOL_NONE:
-                    # If the new tool is on the same toolchanger as the current tool.
-                    if self.toolchanger == at.toolchanger:
-                        at.deselect()
-                    # If on different toolchanger:
+                # Print time before the change, to measure the full transition.
+                # This also waits for all moves before the change to be planned.
+                toolhead = self.printer.lookup_object("toolhead")
+                transition_start = toolhead.get_last_move_time()
+
+                # Learn the change and undo a preheat of another tool.
+                if self._ktc.predictive_preheat:
+                    eventtime = self.reactor.monotonic()
+                    self.log.track_next_tool(self, eventtime)
+                    self._ktc.resolve_predictive_preheat(self, eventtime)
+
+                # Heater targets are set once, before the toolchange moves.
+                with self._ktc.heater_batch():
+                    # If the new tool to be selected has any heaters prepare warmup before
+                    # actual tool change so all moves will be done while heating up.
+                    if len(self.extruder.heaters) > 0:
+                        self.set_heaters(heater_state=HeaterStateType.ACTIVE)
+
+                    # Put all other active heaters in standby.
+                    own_heaters = self.extruder.heater_names()
+                    for heater in ( heater for heater in self._ktc.all_heaters.values()
+                                    if heater.state == HeaterStateType.ACTIVE
+                                    and heater.name not in own_heaters):
+                        heater.state = HeaterStateType.STANDBY
+
+                # Deselect and select only the tools between the active tool and
+                # this tool, in the planned order. This tool is selected below.
+                for action, tool in self._ktc.tool_tree.plan_toolchange(at, self):
+                    if tool is self:
+                        continue
+                    if action == ToolchangeActionType.DESELECT:
+                        tool.deselect()
                     else:
-                        # First deselect all tools recursively.
-                        # Only if force_deselect_when_parent_deselects is True for the tool.
-                        tools = self._get_list_from_tool_traversal_conditional(
-                            at, "force_deselect_when_parent_deselects", True)
-                        for t in tools:
-                            t.deselect()
-                            # Check if the tool to be deselected is on the same toolchanger.
-                            # Then don't deselect beyond that tool.
-                            if t.toolchanger == self.toolchanger:
-                                break
-                        # Then select the new tools recursively in reverse order
-                        # by getting the list of tools not already selected.
-                        tools = self._get_list_from_tool_traversal_conditional(
-                            self, "state", self.StateType.SELECTED, operator.ne)
-                        for t in reversed(tools):
-                            t.select()
-
-            # If already selected then do nothing.
-            if self.state == self.StateType.SELECTED or self.state == self.StateType.ACTIVE:
+                        tool.select()
+
+            # If already selected then only make it active if it is the final tool.
+            # No pickup is run so it is not counted in selects_started or
+            # selects_completed, as before.
+            if self.StateType.SELECTED in (previous_state, self.state):
+                self.state = self.StateType.SELECTED
+                if final_selected:
+                    self._set_as_active_tool()
+                    self.log.track_tool_transition(
+                        at, self, toolhead.get_last_move_time() - transition_start)
+                return
+            if self.state == self.StateType.ACTIVE:
                 return
 
             # Now we asume tool has been dropped if needed be.
@@ -165,13 +187,7 @@ class KtcTool(KtcBaseToolClass, KtcConstantsClass):
                 self.state = self.StateType.SELECTING
                 self.toolchanger.state = self.toolchanger.StateType.CHANGING
                 self._ktc.state = self.StateType.CHANGING
-                tool_select_gcode_template = self.gcode_macro.load_template(
-                    self.config, "", self._tool_select_gcode)
-                context = tool_select_gcode_template.create_template_context()
-                context['myself'] = self.get_status()
-                context['ktc'] = self._ktc.get_status()
-                context['STATE_TYPE'] = self.StateType
-                tool_select_gcode_template.run_gcode_from_command(context)
+                self.run_gcode_template("_tool_select_gcode")
                 # Check that the gcode has changed the state.
             except Exception as e:
                 raise Exception("Failed to run tool_select_gcode: " + str(e)) from e
@@ -188,18 +204,9 @@ class KtcTool(KtcBaseToolClass, KtcConstantsClass):
                 )
 
             if final_selected and self.state == self.StateType.SELECTED:
-                # Restore fan if has a fan.
-                for fan in self.fans:
-                    self.gcode.run_script_from_command(
-                        "SET_FAN_SPEED FAN="
-                        + fan[0]
-                        + " SPEED="
-                        + str(self._ktc.saved_fan_speed * float(fan[1]))
-                    )
-
-                self._ktc.active_tool = self
-                self.log.track_tool_selected_start(self)
-                self.state = self.StateType.ACTIVE
+                self._set_as_active_tool()
+                self.log.track_tool_transition(
+                    at, self, toolhead.get_last_move_time() - transition_start)
 
             self.log.tool_stats[self.name].selects_completed += 1
 
@@ -211,6 +218,23 @@ class KtcTool(KtcBaseToolClass, KtcConstantsClass):
         finally:
             self.log.track_tool_selecting_end(self)
 
+    def _set_as_active_tool(self):
+        """Restore the fans and make this selected tool the active tool."""
+        # Restore fan if has a fan.
+        for fan in self.fans:
+            self.gcode.run_script_from_command(
+                "SET_FAN_SPEED FAN="
+                + fan[0]
+                + " SPEED="
+                + str(self._ktc.saved_fan_speed * float(fan[1]))
+            )
+
+        self._ktc.active_tool = self
+        self.log.track_tool_selected_start(self)
+        self.state = self.StateType.ACTIVE
+        self._ktc.add_to_warm_pool(self)
+        self._ktc.schedule_predictive_preheat(self, self.reactor.monotonic())
+
     def deselect(self):    # pylint: disable=arguments-differ
         self.state = self.StateType.DESELECTING
         try:
@@ -222,6 +246,8 @@ class KtcTool(KtcBaseToolClass, KtcConstantsClass):
             self.log.tool_stats[self.name].deselects_started += 1
 
             self.extruder.state = HeaterStateType.STANDBY
+            # A deferred wait for the heaters going to standby is obsolete.
+            self._ktc.discard_pending_temperature_wait(self.extruder.heater_names())
 
             # Turn off fan if has a fan.
             self._ktc.tool_fan_speed_set(self, 0)
@@ -240,13 +266,7 @@ class KtcTool(KtcBaseToolClass, KtcConstantsClass):
                     t.select()
 
             try:
-                gcode_template = self.gcode_macro.load_template(
-                    self.config, "", self._tool_deselect_gcode)
-                context = gcode_template.create_template_context()
-                context['myself'] = self.get_status()
-                context['ktc'] = self._ktc.get_status()
-                context['STATE_TYPE'] = self.StateType
-                gcode_template.run_gcode_from_command(context)
+                self.run_gcode_template("_tool_deselect_gcode")
             except Exception as e:
                 raise Exception("Failed to run tool_deselect_gcode: " + str(e)) from e
             # Check that the gcode has changed the state.
@@ -275,26 +295,10 @@ class KtcTool(KtcBaseToolClass, KtcConstantsClass):
     def _get_list_from_tool_traversal_conditional(
         self, start_tool: KtcBaseToolClass, param: str,
         value, condition = operator.eq) -> typing.List[KtcTool]:
-        return_list = []
-
-        if start_tool in (
-            self.TOOL_NONE,
-            self.TOOL_UNKNOWN,
-            self._ktc,
-            None
-        ):
-            return return_list
-
-        if condition(getattr(start_tool, param), value):
-            return_list.append(start_tool)
-
-        upper_tool = start_tool.toolchanger.parent_tool
-
-        if upper_tool is not None:
-            return_list += self._get_list_from_tool_traversal_conditional(
-                upper_tool, param, value, condition)
-
-        return return_list
+        """Return start_tool and its parent tools, deepest first,
+        that fulfill the condition for param."""
+        return [tool for tool in self._ktc.tool_tree.ancestors(start_tool)
+                if condition(getattr(tool, param), value)]
 
     def set_heaters(self, **kwargs) -> None:
         if len(self.extruder.heaters) < 1:
@@ -314,20 +318,22 @@ class KtcTool(KtcBaseToolClass, KtcConstantsClass):
             self.log.always("KTC Tool %s is not a valid tool to set heaters for." % self.name)
             return
 
-        for i in kwargs:    # pylint: disable=consider-using-dict-items
-            if i == "heater_active_temp":
-                ex.active_temp = kwargs[i]
-            elif i == "heater_standby_temp":
-                ex.standby_temp = kwargs[i]
-            elif i == "heater_active_to_standby_delay":
-                ex.active_to_standby_delay = kwargs[i]
-                changing_timer = True
-            elif i == "heater_standby_to_powerdown_delay":
-                ex.standby_to_powerdown_delay = kwargs[i]
-                changing_timer = True
-        if "heater_state" in kwargs:
-            chng_state = HeaterStateType.parse_heater_state(kwargs["heater_state"])
-            ex.state = chng_state
+        # Each heater target is set once after all settings are changed.
+        with self._ktc.heater_batch():
+            for i in kwargs:    # pylint: disable=consider-using-dict-items
+                if i == "heater_active_temp":
+                    ex.active_temp = kwargs[i]
+                elif i == "heater_standby_temp":
+                    ex.standby_temp = kwargs[i]
+                elif i == "heater_active_to_standby_delay":
+                    ex.active_to_standby_delay = kwargs[i]
+                    changing_timer = True
+                elif i == "heater_standby_to_powerdown_delay":
+                    ex.standby_to_powerdown_delay = kwargs[i]
+                    changing_timer = True
+            if "heater_state" in kwargs:
+                chng_state = HeaterStateType.parse_heater_state(kwargs["heater_state"])
+                ex.state = chng_state
 
         # If already in standby and timers are counting down,
         # i.e. have not triggered since set in standby,
@@ -338,29 +344,37 @@ class KtcTool(KtcBaseToolClass, KtcConstantsClass):
                 ht = self._ktc.all_heaters[hs.name]
                 if ht.timer_heater_standby_to_powerdown_delay.counting_down:
                     ht.timer_heater_standby_to_powerdown_delay.set_timer(
-                        ex.standby_to_powerdown_delay)
+                        ex.effective_standby_to_powerdown_delay())
                 if ht.timer_heater_active_to_standby_delay.counting_down:
                     ht.timer_heater_active_to_standby_delay.set_timer(
                         ex.active_to_standby_delay)
 
+    # Status fields as name: getter(self). Read lazily by G-code templates.
+    _STATUS_FIELDS = {
+        "name": lambda self: self.name,
+        "number": lambda self: self.number,
+        "state": lambda self: self.state,
+        "active": lambda self: int(self is self._ktc.active_tool),
+        "toolchanger": lambda self: self.toolchanger.name,
+        "fans": lambda self: self.fans,
+        "offset": lambda self: [self.offset[i] + self._ktc.global_offset[i] for i in range(3)],
+        "heater_names": lambda self: [heater.name for heater in self.extruder.heaters],
+        "heater_state": lambda self: self.extruder.state,
+        "heater_active_temp": lambda self: self.extruder.active_temp,
+        "heater_standby_temp": lambda self: self.extruder.standby_temp,
+        "heater_active_to_standby_delay": lambda self: self.extruder.active_to_standby_delay,
+        "standby_to_powerdown_delay": lambda self: self.extruder.standby_to_powerdown_delay,
+        "heater_effective_active_to_standby_delay": lambda self: (
+            self.extruder.effective_active_to_standby_delay()),
+        "heater_idle_interval_estimate": lambda self: (
+            self.extruder.idle_intervals.estimate()),
+        "gcode_template_cache_hits": lambda self: self.gcode_template_cache_hits,
+        "gcode_template_cache_misses": lambda self: self.gcode_template_cache_misses,
+        "params_available": lambda self: str(self.params.keys()),
+    }
+
     def get_status(self, eventtime=None):  # pylint: disable=unused-argument
-        status = {
-            "name": self.name,
-            "number": self.number,
-            "state": self.state,
-            "toolchanger": self.toolchanger.name,
-            "fans": self.fans,
-            "offset": [self.offset[i] + self._ktc.global_offset[i] for i in range(3)],
-            "heater_names": [heater.name for heater in self.extruder.heaters],
-            "heater_state": self.extruder.state,
-            "heater_active_temp": self.extruder.active_temp,
-            "heater_standby_temp": self.extruder.standby_temp,
-            "heater_active_to_standby_delay": self.extruder.active_to_standby_delay,
-            "standby_to_powerdown_delay": self.extruder.standby_to_powerdown_delay,
-            "params_available": str(self.params.keys()),
-            **self.params,
-        }
-        return status
+        return self._status_from_fields()
 
     ###########################################
     # Dataclassess for KtcTool
@@ -0,0 +1,49 @@
+# KTC - Klipper Tool Changer code
+# Named groups of tools for bulk commands
+#
+# Copyright (C) 2024  Andrei Ignat <andrei@ignat.se>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+
+import typing
+
+# Only import these modules in Dev environment. Consult Dev_doc.md for more info.
+if typing.TYPE_CHECKING:
+    from ...klipper.klippy import configfile
+    from . import ktc_tool
+
+
+class KtcToolGroup:
+    """Named list of tools, selected with GROUP=<name> by the commands taking
+    a tool group."""
+
+    def __init__(self, config: 'configfile.ConfigWrapper'):
+        self.config = config
+        self.name: str = config.get_name().split(" ", 1)[1]
+        self.tool_names: list[str] = [
+            name for name in typing.cast(
+                str, config.get("tools")).replace(" ", "").split(",")  # type: ignore
+            if name]
+        if not self.tool_names:
+            raise config.error(f"No tools specified for ktc_tool_group {self.name}.")
+        # Set by Ktc when all tools are configured.
+        self.tools: list['ktc_tool.KtcTool'] = []
+
+    def configure_tools(self, all_tools: dict[str, 'ktc_tool.KtcTool']):
+        """Resolve the tool names, called by Ktc after all tools are configured."""
+        for name in self.tool_names:
+            if name not in all_tools:
+                raise self.config.error(
+                    f"Tool {name} in ktc_tool_group {self.name} not found.")
+        self.tools = [all_tools[name] for name in self.tool_names]
+
+    def get_status(self, eventtime=None):  # pylint: disable=unused-argument
+        return {
+            "name": self.name,
+            "tools": self.tool_names,
+        }
+
+
+def load_config_prefix(config):
+    return KtcToolGroup(config)
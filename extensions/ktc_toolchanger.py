@@ -66,6 +66,7 @@ class KtcToolchanger(KtcBaseChangerClass, KtcConstantsClass):
         super().configure_inherited_params()
         self.gcode_macro = typing.cast('klippy_gcode_macro.PrinterGCodeMacro', # type: ignore # pylint: disable=attribute-defined-outside-init
                                   self.printer.lookup_object("gcode_macro"))    # type: ignore
+        self._build_gcode_template_cache()
         self.state = self.StateType.CONFIGURED  # pylint: disable=attribute-defined-outside-init # pylint bug
 
     def initialize(self):
@@ -118,13 +119,7 @@ class KtcToolchanger(KtcBaseChangerClass, KtcConstantsClass):
         # Run the init gcode template if it is defined.
         if self._init_gcode != "":
             self.log.trace(f"Initalizing ktc_toolchanger {self.name}.")
-            init_gcode_template = self.gcode_macro.load_template(   # type: ignore
-                self.config, "", self._init_gcode)
-            context = init_gcode_template.create_template_context()
-            context['myself'] = self.get_status()
-            context['ktc'] = self._ktc.get_status()
-            context['STATE_TYPE'] = self.StateType
-            init_gcode_template.run_gcode_from_command(context)
+            self.run_gcode_template("_init_gcode")
             # Check that the gcode has changed the state.
             if self.state == self.StateType.CONFIGURED:
                 raise self.config.error(
@@ -162,13 +157,7 @@ class KtcToolchanger(KtcBaseChangerClass, KtcConstantsClass):
             if self.state >= self.StateType.ENGAGING:
                 self.state = self.StateType.ENGAGING
 
-            engage_gcode_template = self.gcode_macro.load_template(
-                self.config, "", self._engage_gcode)
-            context = engage_gcode_template.create_template_context()
-            context['myself'] = self.get_status()
-            context['ktc'] = self._ktc.get_status()
-            context['STATE_TYPE'] = self.StateType
-            engage_gcode_template.run_gcode_from_command(context)
+            self.run_gcode_template("_engage_gcode")
 
             if (self.state == self.StateType.ENGAGING or
                 self.state == self.StateType.INITIALIZING):
@@ -214,13 +203,7 @@ class KtcToolchanger(KtcBaseChangerClass, KtcConstantsClass):
             if self.state >= self.StateType.DISENGAGING:
                 self.state = self.StateType.DISENGAGING
 
-            disengage_gcode_template = self.gcode_macro.load_template(
-                self.config, "", self._disengage_gcode)
-            context = disengage_gcode_template.create_template_context()
-            context['myself'] = self.get_status()
-            context['ktc'] = self._ktc.get_status()
-            context['STATE_TYPE'] = self.StateType
-            disengage_gcode_template.run_gcode_from_command(context)
+            self.run_gcode_template("_disengage_gcode")
 
             if (self.state == self.StateType.DISENGAGING or
                 self.state == self.StateType.INITIALIZING):
@@ -258,18 +241,21 @@ class KtcToolchanger(KtcBaseChangerClass, KtcConstantsClass):
             self.log.always("KTC is now in error state.")
             self.selected_tool = self.TOOL_UNKNOWN
 
+    # Status fields as name: getter(self). Read lazily by G-code templates.
+    _STATUS_FIELDS = {
+        "name": lambda self: self.name,
+        "selected_tool": lambda self: self.selected_tool.name,
+        "selected_tool_n": lambda self: self.selected_tool.number,
+        "state": lambda self: self.state,
+        "init_mode": lambda self: self.init_mode,
+        "tools": lambda self: list(self.tools),
+        "gcode_template_cache_hits": lambda self: self.gcode_template_cache_hits,
+        "gcode_template_cache_misses": lambda self: self.gcode_template_cache_misses,
+        "params_available": lambda self: str(self.params.keys()),
+    }
+
     def get_status(self, eventtime=None):   # pylint: disable=unused-argument
-        status = {
-            "name": self.name,
-            "selected_tool": self.selected_tool.name,
-            "selected_tool_n": self.selected_tool.number,
-            "state": self.state,
-            "init_mode": self.init_mode,
-            "tools": list(self.tools),
-            "params_available": str(self.params.keys()),
-            **self.params,
-        }
-        return status
+        return self._status_from_fields()
 
     @unique
     class InitModeType(str, KtcConfigurableEnum):
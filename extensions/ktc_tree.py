@@ -0,0 +1,179 @@
+# KTC - Klipper Tool Changer code (v.2)
+# Precomputed index of the tree of nested toolchangers and tools.
+#
+# Copyright (C) 2024 Andrei Ignat <andrei@ignat.se>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+from __future__ import annotations
+import typing
+from enum import Enum, unique
+
+# Only import these modules in Dev environment. Consult Dev_doc.md for more info.
+if typing.TYPE_CHECKING:
+    from . import ktc_tool, ktc_toolchanger
+
+
+@unique
+class ToolchangeActionType(str, Enum):
+    """Actions in a toolchange plan.
+    Inherits from str so it can be JSON serializable."""
+    DESELECT = "deselect"
+    SELECT = "select"
+
+
+class KtcToolTree:
+    """Immutable index of the tool tree, built once when all tools and
+    toolchangers are configured.
+
+    For each tool it holds the chain of the tool followed by all its parent
+    tools up to the default toolchanger and the depth of the tool.
+    Tools on the default toolchanger have depth 0.
+    It also holds all tools in post-order, children before their parent."""
+
+    def __init__(
+        self,
+        default_toolchanger: "ktc_toolchanger.KtcToolchanger",
+        tools_having_tc: typing.Mapping[
+            "ktc_tool.KtcTool", "ktc_toolchanger.KtcToolchanger"],
+    ):
+        chains: dict["ktc_tool.KtcTool", tuple["ktc_tool.KtcTool", ...]] = {}
+        post_order: list["ktc_tool.KtcTool"] = []
+
+        def _index(tc: "ktc_toolchanger.KtcToolchanger",
+                   parents: tuple["ktc_tool.KtcTool", ...]):
+            for tool in tc.tools.values():
+                chain = (tool,) + parents
+                chains[tool] = chain
+                child_tc = tools_having_tc.get(tool)
+                if child_tc is not None:
+                    _index(child_tc, chain)
+                post_order.append(tool)
+
+        _index(default_toolchanger, ())
+        self._chains = chains
+        self._child_toolchangers = dict(tools_having_tc)
+        self.post_order: tuple["ktc_tool.KtcTool", ...] = tuple(post_order)
+
+    def ancestors(self, tool) -> tuple["ktc_tool.KtcTool", ...]:
+        """Return the tool followed by its parent tools, deepest first.
+        Returns an empty tuple for tools not in the tree like TOOL_NONE."""
+        return self._chains.get(tool, ())
+
+    def depth(self, tool) -> int:
+        """Return the depth of the tool. Tools on the default toolchanger
+        have depth 0. Returns -1 for tools not in the tree."""
+        return len(self._chains.get(tool, ())) - 1
+
+    def lowest_common_ancestor(self, tool_a, tool_b) -> typing.Optional["ktc_tool.KtcTool"]:
+        """Return the deepest tool that is in the chain of both tools.
+        A tool is considered an ancestor of itself.
+        Returns None when the tools only share the default toolchanger."""
+        chain_a = self._chains.get(tool_a, ())
+        chain_b = self._chains.get(tool_b, ())
+        # Align both chains at the same depth and walk up until they meet.
+        index_a = max(len(chain_a) - len(chain_b), 0)
+        index_b = max(len(chain_b) - len(chain_a), 0)
+        while index_a < len(chain_a):
+            if chain_a[index_a] is chain_b[index_b]:
+                return chain_a[index_a]
+            index_a += 1
+            index_b += 1
+        return None
+
+    def _deselect_order(self, tool) -> list["ktc_tool.KtcTool"]:
+        """Return the tool and the tools left selected below it that are
+        forced to deselect when their parent deselects, deepest first."""
+        order = [tool]
+        child_tc = self._child_toolchangers.get(tool)
+        while child_tc is not None:
+            child = child_tc.selected_tool
+            if (child not in self._chains
+                or not child.force_deselect_when_parent_deselects):
+                break
+            order.append(child)
+            child_tc = self._child_toolchangers.get(child)
+        order.reverse()
+        return order
+
+    def plan_toolchange(self, current, target) -> list[
+        tuple[ToolchangeActionType, "ktc_tool.KtcTool"]]:
+        """Return the ordered list of (action, tool) needed to change from the
+        current tool to the target tool.
+
+        Only tools below the lowest common ancestor of the two tools are changed:
+        - The topmost tool of the current branch is deselected to free its
+          toolchanger. Tools below it are only deselected when they have
+          force_deselect_when_parent_deselects, otherwise they are left selected
+          on their toolchanger.
+        - Tools of the target branch are selected top down unless already selected.
+          Another tool left selected on one of their toolchangers is deselected
+          first, before its parent is selected if it has
+          parent_must_be_selected_on_deselect set to False.
+        The current tool can be TOOL_NONE. The target tool is not in the plan
+        if it is already selected."""
+        chain_target = self._chains.get(target)
+        if chain_target is None:
+            raise ValueError(f"Tool {target.name} is not a valid tool to change to.")
+        if current is target:
+            return []
+
+        chain_current = self._chains.get(current, ())
+        common_depth = self.depth(self.lowest_common_ancestor(current, target))
+        # Tools below the common ancestor, deepest first.
+        branch_current = chain_current[:len(chain_current) - 1 - common_depth]
+        branch_target = chain_target[:len(chain_target) - 1 - common_depth]
+
+        deselecting: list["ktc_tool.KtcTool"] = []
+        if branch_current:
+            top = branch_current[-1]
+            # When the target is a parent of the current tool, the toolchanger
+            # is not needed and the current tool is only deselected if forced to.
+            if branch_target or top.force_deselect_when_parent_deselects:
+                deselecting = self._deselect_order(top)
+        plan = [(ToolchangeActionType.DESELECT, tool) for tool in deselecting]
+
+        # Select the target branch from the top down.
+        for tool in reversed(branch_target):
+            if tool.state == tool.StateType.SELECTED:
+                continue
+            occupying = tool.toolchanger.selected_tool
+            if (occupying is not tool and occupying in self._chains
+                and occupying not in deselecting):
+                stale = self._deselect_order(occupying)
+                deselecting.extend(stale)
+                stale_actions = [(ToolchangeActionType.DESELECT, t) for t in stale]
+                parent_select = (ToolchangeActionType.SELECT,
+                                 tool.toolchanger.parent_tool)
+                if (not occupying.parent_must_be_selected_on_deselect
+                    and parent_select in plan):
+                    i = plan.index(parent_select)
+                    plan[i:i] = stale_actions
+                else:
+                    plan.extend(stale_actions)
+            plan.append((ToolchangeActionType.SELECT, tool))
+        return plan
+
+    def legacy_plan_length(self, current, target) -> int:
+        """Return the number of tool selects and deselects the toolchange logic
+        before the planner would run to change from current to target.
+        Used to compare the planner with the previous behaviour."""
+        if current is target:
+            return 0
+        chain_current = self._chains.get(current, ())
+        chain_target = self._chains.get(target, ())
+        if not chain_current:
+            return 1
+        if current.toolchanger is target.toolchanger:
+            return 2
+        deselected = []
+        for tool in chain_current:
+            if tool.force_deselect_when_parent_deselects:
+                deselected.append(tool)
+                if tool.toolchanger is target.toolchanger:
+                    break
+        # The legacy logic selects all tools in the target chain not in SELECTED
+        # state. The target tool itself is included as it is selected last.
+        selected = [tool for tool in chain_target
+                    if tool in deselected or tool.state != tool.StateType.SELECTED
+                    or tool is target]
+        return len(deselected) + len(selected)
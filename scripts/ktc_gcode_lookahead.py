@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# KTC - Klipper Tool Changer code (v.2)
+# G-code post-processor inserting tool preheat commands ahead of toolchanges.
+#
+# Copyright (C) 2024 Andrei Ignat <andrei@ignat.se>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+
+# The file is read twice, line by line, so memory use does not depend on the
+# file size. Only the toolchanges are kept between the passes.
+#
+# The first pass estimates the print time at each toolchange.
+# The second pass writes the file with a
+#   KTC_TOOL_SET_TEMPERATURE T=<index> CHNG_STATE=ACTIVE
+# inserted the set number of seconds of print time before each toolchange.
+#
+# When a tool is selected KTC puts the heaters of all other tools in standby,
+# so the preheat is never inserted before the previous toolchange.
+# The first toolchange is left to be heated by the start G-code.
+#
+# Can be used as a slicer post-processing script, the file is then
+# changed in place:
+#   python3 ktc_gcode_lookahead.py --lead 30 file.gcode
+
+from __future__ import annotations
+import argparse, math, os, re, shutil, tempfile, typing
+
+DEFAULT_LEAD_TIME = 30.0        # Seconds of print time to preheat before a change.
+DEFAULT_TOOLCHANGE_TIME = 10.0  # Estimated seconds each toolchange takes.
+DEFAULT_ACCEL = 3000.0          # mm/s^2 if the file doesn't set it.
+DEFAULT_MAX_VELOCITY = 300.0    # mm/s, caps F values in the file.
+DEFAULT_FEEDRATE = 1500.0       # mm/min until the first F value.
+PREHEAT_COMMENT = "; KTC lookahead preheat"
+
+# Classic G-code words like X10.5 or E-0.8.
+_WORD_RE = re.compile(r"([A-Z])\s*([-+]?(?:\d+\.?\d*|\.\d+))")
+_TOOLCHANGE_RE = re.compile(r"^(?:KTC_)?T(\d+)$")
+
+def split_command(line: str) -> tuple[str, str]:
+    """Return the upper case command and the rest of the line without comments.
+    Returns an empty command for empty or comment only lines."""
+    line = line.split(";", 1)[0].strip()
+    if not line:
+        return "", ""
+    parts = line.split(None, 1)
+    return parts[0].upper(), (parts[1] if len(parts) > 1 else "")
+
+def parse_words(args: str) -> dict[str, float]:
+    """Parse classic G-code parameters like "X10 Y5 E.3" into a dict."""
+    return {k: float(v) for k, v in _WORD_RE.findall(args.upper())}
+
+def parse_extended(args: str) -> dict[str, str]:
+    """Parse extended G-code parameters like "ACCEL=3000" into a dict."""
+    params = {}
+    for part in args.split():
+        if "=" in part:
+            k, v = part.split("=", 1)
+            params[k.upper()] = v
+    return params
+
+def toolchange_number(cmd: str) -> typing.Optional[int]:
+    """Return the tool number if the command is T<index> or KTC_T<index>."""
+    match = _TOOLCHANGE_RE.match(cmd)
+    return int(match.group(1)) if match else None
+
+
+class GcodeTimeEstimator:
+    """Estimates the print time of G-code one line at a time.
+
+    Moves are trapezoids accelerating from and to standstill, so the estimate
+    is slightly pessimistic. Handles G0-G3, G4, G28, G90/G91, M82/M83, G92,
+    M204 and SET_VELOCITY_LIMIT."""
+
+    def __init__(self, accel: float = DEFAULT_ACCEL,
+                 max_velocity: float = DEFAULT_MAX_VELOCITY,
+                 toolchange_time: float = DEFAULT_TOOLCHANGE_TIME):
+        self.accel = accel
+        self.max_velocity = max_velocity
+        self.toolchange_time = toolchange_time
+        self.time = 0.0
+        self.position = [0.0, 0.0, 0.0, 0.0]
+        self.feedrate = DEFAULT_FEEDRATE / 60.
+        self.absolute_coord = True
+        self.absolute_extrude = True
+        self.active_tool: typing.Optional[int] = None
+
+    def _move_time(self, distance: float) -> float:
+        if distance <= 0.:
+            return 0.
+        velocity = min(self.feedrate, self.max_velocity)
+        accel_distance = velocity * velocity / self.accel
+        if distance >= accel_distance:
+            return distance / velocity + velocity / self.accel
+        return 2. * math.sqrt(distance / self.accel)
+
+    def _new_position(self, words: dict[str, float]) -> list[float]:
+        new_pos = list(self.position)
+        for i, axis in enumerate("XYZE"):
+            if axis not in words:
+                continue
+            if axis == "E":
+                absolute = self.absolute_coord and self.absolute_extrude
+            else:
+                absolute = self.absolute_coord
+            new_pos[i] = words[axis] if absolute else new_pos[i] + words[axis]
+        return new_pos
+
+    def process(self, cmd: str, args: str) -> float:
+        """Add the time of the command and return the new estimated time."""
+        if cmd in ("G0", "G1", "G2", "G3"):
+            words = parse_words(args)
+            if "F" in words and words["F"] > 0.:
+                self.feedrate = words["F"] / 60.
+            new_pos = self._new_position(words)
+            dx, dy, dz, de = (n - o for n, o in zip(new_pos, self.position))
+            if cmd in ("G2", "G3") and ("I" in words or "J" in words):
+                radius = math.hypot(words.get("I", 0.), words.get("J", 0.))
+                # Angle between the vectors from the center to start and end.
+                cx = self.position[0] + words.get("I", 0.)
+                cy = self.position[1] + words.get("J", 0.)
+                start = math.atan2(self.position[1] - cy, self.position[0] - cx)
+                end = math.atan2(new_pos[1] - cy, new_pos[0] - cx)
+                angle = end - start if cmd == "G3" else start - end
+                if angle <= 0.:
+                    angle += 2. * math.pi
+                planar = radius * angle
+            else:
+                planar = math.hypot(dx, dy)
+            distance = math.hypot(planar, dz)
+            # Extrude only moves.
+            if distance == 0.:
+                distance = abs(de)
+            self.time += self._move_time(distance)
+            self.position = new_pos
+        elif cmd == "G4":
+            words = parse_words(args)
+            self.time += words.get("P", 0.) / 1000. + words.get("S", 0.)
+        elif cmd == "G28":
+            # Homing time is unknown, it only happens at print start anyway.
+            self.position[:3] = [0., 0., 0.]
+        elif cmd == "G90":
+            self.absolute_coord = True
+        elif cmd == "G91":
+            self.absolute_coord = False
+        elif cmd == "M82":
+            self.absolute_extrude = True
+        elif cmd == "M83":
+            self.absolute_extrude = False
+        elif cmd == "G92":
+            words = parse_words(args)
+            for i, axis in enumerate("XYZE"):
+                if axis in words:
+                    self.position[i] = words[axis]
+        elif cmd == "M204":
+            words = parse_words(args)
+            accel = words.get("S", min(words.get("P", math.inf), words.get("T", math.inf)))
+            if 0. < accel < math.inf:
+                self.accel = accel
+        elif cmd == "SET_VELOCITY_LIMIT":
+            params = parse_extended(args)
+            try:
+                if "ACCEL" in params:
+                    self.accel = float(params["ACCEL"]) or self.accel
+                if "VELOCITY" in params:
+                    self.max_velocity = float(params["VELOCITY"]) or self.max_velocity
+            except ValueError:
+                pass
+        elif toolchange_number(cmd) is not None:
+            tool = toolchange_number(cmd)
+            # Selecting the active tool again does nothing.
+            if tool != self.active_tool:
+                self.time += self.toolchange_time
+                self.active_tool = tool
+        return self.time
+
+
+class Toolchange:
+    """A toolchange found in the first pass."""
+    __slots__ = ("line", "time", "tool", "previous_tool", "window_start",
+                 "preheat_time")
+
+    def __init__(self, line: int, time: float, tool: int,
+                 previous_tool: typing.Optional[int], window_start: float):
+        self.line = line                    # Line number of the change.
+        self.time = time                    # Estimated time when the change starts.
+        self.tool = tool
+        self.previous_tool = previous_tool
+        self.window_start = window_start    # Earliest time a preheat is kept.
+        self.preheat_time: typing.Optional[float] = None
+
+
+def find_toolchanges(path: str, estimator: GcodeTimeEstimator) -> list[Toolchange]:
+    """First pass: estimate the time of every toolchange in the file."""
+    changes: list[Toolchange] = []
+    active_tool = None
+    last_change_end = 0.
+    with open(path, encoding="utf-8", errors="surrogateescape") as f:
+        for line_nr, line in enumerate(f):
+            cmd, args = split_command(line)
+            if not cmd:
+                continue
+            tool = toolchange_number(cmd)
+            if tool is not None and tool != active_tool:
+                changes.append(Toolchange(line_nr, estimator.time, tool,
+                                          active_tool, last_change_end))
+                active_tool = tool
+                last_change_end = estimator.process(cmd, args)
+            else:
+                estimator.process(cmd, args)
+    return changes
+
+def plan_preheats(changes: list[Toolchange], lead: float, min_lead: float):
+    """Set the preheat time of each change that gains at least min_lead seconds."""
+    for change in changes:
+        # The first tool is heated by the start G-code.
+        if change.previous_tool is None:
+            continue
+        preheat_time = max(change.time - lead, change.window_start)
+        if change.time - preheat_time < min_lead or change.time - preheat_time <= 0.:
+            continue
+        change.preheat_time = preheat_time
+
+def write_with_preheats(path: str, out, changes: list[Toolchange],
+                        estimator: GcodeTimeEstimator):
+    """Second pass: copy the file inserting the planned preheats.
+    A preheat is written before the first command ending after its time."""
+    pending = iter(sorted((c for c in changes if c.preheat_time is not None),
+                          key=lambda c: (c.preheat_time, c.line)))
+    next_preheat = next(pending, None)
+    with open(path, encoding="utf-8", errors="surrogateescape") as f:
+        for line_nr, line in enumerate(f):
+            cmd, args = split_command(line)
+            if cmd:
+                end_time = estimator.process(cmd, args)
+                while next_preheat is not None and (
+                    end_time > next_preheat.preheat_time
+                    or line_nr >= next_preheat.line
+                    ):
+                    out.write("KTC_TOOL_SET_TEMPERATURE T=%d CHNG_STATE=ACTIVE "
+                              "%s %.1fs before T%d\n"
+                              % (next_preheat.tool, PREHEAT_COMMENT,
+                                 next_preheat.time - next_preheat.preheat_time,
+                                 next_preheat.tool))
+                    next_preheat = next(pending, None)
+            out.write(line)
+
+def format_time(seconds: float) -> str:
+    seconds = int(round(seconds))
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def timeline_report(changes: list[Toolchange]) -> str:
+    """Return a human readable table of the toolchanges and preheats."""
+    lines = ["KTC toolchange timeline:",
+             "%6s %10s %6s %8s %10s %6s" % ("#", "line", "tool", "time",
+                                            "preheat", "lead")]
+    for i, change in enumerate(changes, 1):
+        if change.preheat_time is None:
+            preheat, lead = "-", "-"
+        else:
+            preheat = format_time(change.preheat_time)
+            lead = "%.1fs" % (change.time - change.preheat_time)
+        lines.append("%6d %10d %6s %8s %10s %6s" % (
+            i, change.line + 1, "T%d" % change.tool,
+            format_time(change.time), preheat, lead))
+    preheated = [c for c in changes if c.preheat_time is not None]
+    lines.append("%d toolchanges, %d preheats inserted, %.1fs of preheat in total."
+                 % (len(changes), len(preheated),
+                    sum(c.time - c.preheat_time for c in preheated)))
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Insert KTC tool preheat commands ahead of toolchanges.")
+    parser.add_argument("input", help="G-code file to process.")
+    parser.add_argument("-o", "--output",
+                        help="Write to this file instead of changing the input in place.")
+    parser.add_argument("--lead", type=float, default=DEFAULT_LEAD_TIME,
+                        help="Seconds of print time to preheat before each change. "
+                        "Default %(default)s.")
+    parser.add_argument("--min-lead", type=float, default=0.,
+                        help="Don't insert preheats gaining less than this many seconds.")
+    parser.add_argument("--toolchange-time", type=float, default=DEFAULT_TOOLCHANGE_TIME,
+                        help="Estimated seconds per toolchange. Default %(default)s.")
+    parser.add_argument("--accel", type=float, default=DEFAULT_ACCEL,
+                        help="Acceleration in mm/s^2 until set in the file. "
+                        "Default %(default)s.")
+    parser.add_argument("--max-velocity", type=float, default=DEFAULT_MAX_VELOCITY,
+                        help="Maximum velocity in mm/s until set in the file. "
+                        "Default %(default)s.")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Only report the timeline, don't write anything.")
+    args = parser.parse_args(argv)
+
+    def new_estimator():
+        return GcodeTimeEstimator(args.accel, args.max_velocity, args.toolchange_time)
+
+    changes = find_toolchanges(args.input, new_estimator())
+    plan_preheats(changes, args.lead, args.min_lead)
+
+    if not args.dry_run:
+        output = args.output or args.input
+        # Write to a temporary file and rename it so the input is never half written.
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(output)), suffix=".tmp")
+        try:
+            shutil.copymode(args.input, tmp_path)
+            with os.fdopen(fd, "w", encoding="utf-8", errors="surrogateescape") as out:
+                write_with_preheats(args.input, out, changes, new_estimator())
+            os.replace(tmp_path, output)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    print(timeline_report(changes))
+
+if __name__ == "__main__":
+    main()
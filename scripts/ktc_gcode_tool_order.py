@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+# KTC - Klipper Tool Changer code (v.2)
+# G-code post-processor reordering the tool blocks of each layer.
+#
+# Copyright (C) 2024 Andrei Ignat <andrei@ignat.se>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+
+# Slicers often print the tools of each layer in the same order, so every
+# layer starts by changing back to the first tool. This script reads one layer
+# at a time and reorders the blocks started by T<index> or KTC_T<index> to get
+# the lowest toolchange cost, for example alternating T0 T1 | T1 T0 | T0 T1.
+#
+# Blocks are only moved relative to each other when they are independent:
+# - The XY area they extrude in don't overlap.
+# - They only contain moves and other commands in SAFE_COMMANDS.
+#   Any other command, like M106 or G91, pins the block in its place.
+# - They travel in XY before they extrude.
+# A moved block that moves before setting Z or F gets a G1 restoring the Z and F
+# it started with in the input, when the block before it leaves others.
+# Layers are only reordered when using relative extrusion (M83) and
+# absolute coordinates (G90). Each reordered layer is verified to keep the
+# order of all dependent blocks before it is written.
+#
+# The cost table file has one "<from tool> <to tool> <cost>" per line.
+# Changes not in the file cost 1.
+
+from __future__ import annotations
+import argparse, math, os, shutil, tempfile, typing
+from ktc_gcode_lookahead import (split_command, parse_words, parse_extended,
+                                 toolchange_number)
+
+DEFAULT_MAX_BLOCKS = 12         # Layers with more blocks are left unchanged.
+DEFAULT_MAX_LAYER_LINES = 1000000
+DEFAULT_MARGIN = 1.0            # mm added around extrusion areas for overlap.
+LAYER_MARKERS = (";LAYER_CHANGE", ";LAYER:")
+
+# Commands that don't change state used by later blocks.
+SAFE_COMMANDS = ("G0", "G1", "G2", "G3", "G4", "M73", "M204", "M117",
+                 "SET_VELOCITY_LIMIT", "EXCLUDE_OBJECT_START",
+                 "EXCLUDE_OBJECT_END", "SET_PRINT_STATS_INFO")
+# Temperature commands are safe when they specify the tool.
+TOOL_TEMPERATURE_COMMANDS = ("M104", "M109", "M568", "KTC_TOOL_SET_TEMPERATURE")
+
+
+class ToolBlock:
+    """Consecutive lines of a layer printed with the same tool."""
+
+    def __init__(self, tool: typing.Optional[int], z: typing.Optional[float] = None,
+                 feedrate: typing.Optional[float] = None):
+        self.tool = tool
+        # Modal Z and F of the input at the start and end of the block.
+        self.start_z = self.end_z = z
+        self.start_feedrate = self.end_feedrate = feedrate
+        # Set when a move uses the Z or F from before the block.
+        self.uses_z = False
+        self.uses_feedrate = False
+        self.sets_z = False
+        self.sets_feedrate = False
+        self.lines: list[str] = []
+        # Extrusion bounding box as [min x, min y, max x, max y].
+        self.bbox: typing.Optional[list[float]] = None
+        self.pinned = False
+        self.extrudes = False
+        self.traveled = False
+
+    def add_extrusion(self, points):
+        for x, y in points:
+            if self.bbox is None:
+                self.bbox = [x, y, x, y]
+            else:
+                self.bbox = [min(self.bbox[0], x), min(self.bbox[1], y),
+                             max(self.bbox[2], x), max(self.bbox[3], y)]
+
+    def overlaps(self, other: "ToolBlock", margin: float) -> bool:
+        if self.bbox is None or other.bbox is None:
+            return False
+        a, b = self.bbox, other.bbox
+        return not (a[2] + margin < b[0] or b[2] + margin < a[0]
+                    or a[3] + margin < b[1] or b[3] + margin < a[1])
+
+
+class CostTable:
+    """Cost of changing from one tool to another. Defaults to 1."""
+
+    def __init__(self, path: typing.Optional[str] = None):
+        self.costs: dict[tuple[int, int], float] = {}
+        if path is None:
+            return
+        with open(path, encoding="utf-8") as f:
+            for line_nr, line in enumerate(f, 1):
+                line = line.split("#", 1)[0].strip()
+                if not line:
+                    continue
+                try:
+                    from_tool, to_tool, cost = line.split()
+                    self.costs[(int(from_tool), int(to_tool))] = float(cost)
+                except ValueError as e:
+                    raise ValueError("Invalid cost table line %d: %s"
+                                     % (line_nr, line)) from e
+
+    def cost(self, from_tool: typing.Optional[int], to_tool: typing.Optional[int]) -> float:
+        if from_tool == to_tool or to_tool is None:
+            return 0.
+        if from_tool is None:
+            return 1.
+        return self.costs.get((from_tool, to_tool), 1.)
+
+
+class LayerStats:
+    def __init__(self):
+        self.layers = 0
+        self.layers_reordered = 0
+        self.layers_skipped: dict[str, int] = {}
+        self.changes_before = 0
+        self.changes_after = 0
+        self.cost_before = 0.
+        self.cost_after = 0.
+
+    def skip(self, reason: str):
+        self.layers_skipped[reason] = self.layers_skipped.get(reason, 0) + 1
+
+
+class ToolOrderOptimizer:
+    """Reads G-code lines, splits each layer into tool blocks and writes
+    the layers with the blocks in the cheapest valid order."""
+
+    def __init__(self, out, costs: CostTable, max_blocks: int = DEFAULT_MAX_BLOCKS,
+                 margin: float = DEFAULT_MARGIN,
+                 max_layer_lines: int = DEFAULT_MAX_LAYER_LINES):
+        self.out = out
+        self.costs = costs
+        self.max_blocks = max_blocks
+        self.margin = margin
+        self.max_layer_lines = max_layer_lines
+        self.stats = LayerStats()
+        # Modal state of the input file.
+        self.position = [0., 0.]
+        self.z: typing.Optional[float] = None
+        self.feedrate: typing.Optional[float] = None
+        self.absolute_coord = True
+        self.absolute_extrude = True
+        self.input_tool: typing.Optional[int] = None
+        # Active tool after the layers written so far.
+        self.output_tool: typing.Optional[int] = None
+        self.toolchange_prefix = "T"
+        self._layer: list[ToolBlock] = []
+        self._layer_lines = 0
+        self._layer_reorderable = True
+        self._buffering = True
+        self.lines_in = 0
+        self.lines_out = 0
+        self.lines_inserted = 0
+
+    def _write(self, line: str):
+        self.out.write(line)
+        self.lines_out += 1
+
+    def _new_block(self, tool: typing.Optional[int]) -> ToolBlock:
+        return ToolBlock(tool, self.z, self.feedrate)
+
+    def _start_layer(self):
+        self._layer = [self._new_block(self.input_tool)]
+        self._layer_lines = 0
+        self._layer_reorderable = self.absolute_coord and not self.absolute_extrude
+        self._buffering = True
+
+    def feed(self, line: str):
+        """Process one line of the input."""
+        self.lines_in += 1
+        stripped = line.lstrip()
+        if stripped.startswith(LAYER_MARKERS):
+            self.finish_layer()
+            self._start_layer()
+            self.stats.layers += 1
+        elif not self._layer:
+            # Lines before the first layer are written as they are.
+            self._track_state(None, line)
+            self._write(line)
+            self.output_tool = self.input_tool
+            return
+
+        if self._buffering and self._layer_lines >= self.max_layer_lines:
+            # Too large to reorder, write what we have and pass the rest through.
+            self.stats.skip("too many lines")
+            self._write_blocks(self._layer)
+            self._layer = [self._new_block(self.input_tool)]
+            self._buffering = False
+
+        cmd, _ = split_command(line)
+        tool = toolchange_number(cmd)
+        if tool is not None:
+            self.toolchange_prefix = cmd[:-len(str(tool))]
+            if self._buffering:
+                self._layer.append(self._new_block(tool))
+        block = self._layer[-1]
+        self._track_state(block, line)
+        if self._buffering:
+            block.lines.append(line)
+            self._layer_lines += 1
+        else:
+            self._write(line)
+            if tool is not None:
+                self.output_tool = tool
+
+    def _track_state(self, block: typing.Optional[ToolBlock], line: str):
+        """Follow the modal state of the input and record in the block
+        what it extrudes and if it must stay in place."""
+        cmd, args = split_command(line)
+        if not cmd:
+            return
+        tool = toolchange_number(cmd)
+        if tool is not None:
+            self.input_tool = tool
+            return
+        if cmd in ("G0", "G1", "G2", "G3"):
+            words = parse_words(args)
+            start = list(self.position)
+            for i, axis in enumerate("XY"):
+                if axis in words:
+                    if self.absolute_coord:
+                        self.position[i] = words[axis]
+                    else:
+                        self.position[i] += words[axis]
+            if "Z" in words:
+                if self.absolute_coord:
+                    self.z = words["Z"]
+                elif self.z is not None:
+                    self.z += words["Z"]
+            if "F" in words:
+                self.feedrate = words["F"]
+            extrudes = words.get("E", 0.) > 0. and not self.absolute_extrude
+            if block is None:
+                return
+            # Z and F set on the move are set before it is done.
+            block.uses_z |= not block.sets_z and "Z" not in words
+            block.sets_z |= "Z" in words
+            block.uses_feedrate |= not block.sets_feedrate and "F" not in words
+            block.sets_feedrate |= "F" in words
+            block.end_z, block.end_feedrate = self.z, self.feedrate
+            if extrudes:
+                if not block.traveled:
+                    # Extruding from wherever the previous block ended.
+                    block.pinned = True
+                block.extrudes = True
+                points = [start, self.position]
+                if cmd in ("G2", "G3"):
+                    # Use the whole circle of the arc to be safe.
+                    cx = start[0] + words.get("I", 0.)
+                    cy = start[1] + words.get("J", 0.)
+                    r = math.hypot(words.get("I", 0.), words.get("J", 0.))
+                    points += [[cx - r, cy - r], [cx + r, cy + r]]
+                block.add_extrusion(points)
+            elif "X" in words or "Y" in words:
+                block.traveled = True
+            return
+        if cmd == "G90":
+            self.absolute_coord = True
+        elif cmd == "G91":
+            self.absolute_coord = False
+        elif cmd == "M82":
+            self.absolute_extrude = True
+        elif cmd == "M83":
+            self.absolute_extrude = False
+        if block is None:
+            return
+        if cmd == "G92":
+            # Only resetting the extruder position is safe.
+            if set(parse_words(args)) - {"E"}:
+                block.pinned = True
+        elif cmd in TOOL_TEMPERATURE_COMMANDS:
+            words = parse_words(args)
+            params = parse_extended(args)
+            if "T" not in words and "P" not in words and "T" not in params and "TOOL" not in params:
+                block.pinned = True
+        elif cmd not in SAFE_COMMANDS:
+            block.pinned = True
+
+    def _dependencies(self, blocks: list[ToolBlock]) -> list[int]:
+        """Return for each block a bitmask of the blocks that must be before it."""
+        masks = [0] * len(blocks)
+        for j, b in enumerate(blocks):
+            for i in range(j):
+                a = blocks[i]
+                # A pinned block keeps all blocks before it before it,
+                # and all blocks after it after it.
+                if a.pinned or b.pinned or a.overlaps(b, self.margin):
+                    masks[j] |= 1 << i
+        return masks
+
+    def _best_order(self, start_tool, blocks: list[ToolBlock],
+                    masks: list[int]) -> list[int]:
+        """Return the order of blocks with the lowest cost respecting the
+        dependencies. Dynamic programming over the subsets of placed blocks."""
+        n = len(blocks)
+        full = (1 << n) - 1
+        inf = math.inf
+        # best[mask][last] = (cost, previous last)
+        best: list[list[tuple[float, int]]] = [[(inf, -1)] * n for _ in range(1 << n)]
+        for j in range(n):
+            if masks[j] == 0:
+                best[1 << j][j] = (self.costs.cost(start_tool, blocks[j].tool), -1)
+        for mask in range(1, full + 1):
+            row = best[mask]
+            for last in range(n):
+                cost = row[last][0]
+                if cost == inf:
+                    continue
+                for j in range(n):
+                    bit = 1 << j
+                    if mask & bit or masks[j] & ~mask:
+                        continue
+                    new_cost = cost + self.costs.cost(blocks[last].tool, blocks[j].tool)
+                    if new_cost < best[mask | bit][j][0]:
+                        best[mask | bit][j] = (new_cost, last)
+        last = min(range(n), key=lambda j: (best[full][j][0], j))
+        order = []
+        mask = full
+        while last != -1:
+            order.append(last)
+            previous = best[mask][last][1]
+            mask &= ~(1 << last)
+            last = previous
+        order.reverse()
+        return order
+
+    @staticmethod
+    def _verify(blocks: list[ToolBlock], masks: list[int], order: list[int]) -> bool:
+        """Check that the order is a permutation keeping all dependencies."""
+        if sorted(order) != list(range(len(blocks))):
+            return False
+        placed = 0
+        for j in order:
+            if masks[j] & ~placed:
+                return False
+            placed |= 1 << j
+        return True
+
+    def _chain_cost(self, start_tool, tools) -> tuple[float, int]:
+        cost, changes, current = 0., 0, start_tool
+        for tool in tools:
+            if tool != current:
+                cost += self.costs.cost(current, tool)
+                changes += current is not None
+                current = tool
+        return cost, changes
+
+    def _restore_state(self, blocks: list[ToolBlock]):
+        """Insert a G1 at the start of each block using Z or F from before it,
+        when the block written before it ends with a different one."""
+        z, feedrate = blocks[0].end_z, blocks[0].end_feedrate
+        for block in blocks[1:]:
+            words = []
+            if block.uses_z and block.start_z is not None and block.start_z != z:
+                words.append("Z%g" % block.start_z)
+            if (block.uses_feedrate and block.start_feedrate is not None
+                    and block.start_feedrate != feedrate):
+                words.append("F%g" % block.start_feedrate)
+            if words:
+                # After the toolchange starting the block.
+                block.lines.insert(1, "G1 %s\n" % " ".join(words))
+                self.lines_inserted += 1
+            z, feedrate = block.end_z, block.end_feedrate
+
+    def _write_blocks(self, blocks: list[ToolBlock]):
+        for block in blocks:
+            for line in block.lines:
+                self._write(line)
+            if block.tool is not None and block.lines:
+                self.output_tool = block.tool
+
+    def finish_layer(self):
+        """Reorder and write the buffered layer."""
+        if not self._layer:
+            return
+        if not self._buffering:
+            self._layer = []
+            return
+        head, blocks = self._layer[0], self._layer[1:]
+        original_tools = [b.tool for b in blocks]
+        head_tool = self.output_tool
+        # Lines before the first toolchange of the layer extruding with the tool
+        # that was active before the layer in the input need that tool again.
+        if head.extrudes and head.tool is not None and head.tool != self.output_tool:
+            head.lines.insert(0, "%s%d\n" % (self.toolchange_prefix, head.tool))
+            self.lines_inserted += 1
+            self.stats.cost_after += self.costs.cost(self.output_tool, head.tool)
+            self.stats.changes_after += self.output_tool is not None
+            head_tool = head.tool
+
+        order = list(range(len(blocks)))
+        if not blocks:
+            pass
+        elif not self._layer_reorderable:
+            self.stats.skip("absolute extrusion or relative coordinates")
+        elif len(blocks) > self.max_blocks:
+            self.stats.skip("too many tool blocks")
+        else:
+            masks = self._dependencies(blocks)
+            best = self._best_order(head_tool, blocks, masks)
+            if not self._verify(blocks, masks, best):
+                raise RuntimeError("Verification of the reordered layer %d failed."
+                                   % self.stats.layers)
+            if best != order:
+                self.stats.layers_reordered += 1
+                order = best
+                self._restore_state([head] + [blocks[i] for i in order])
+
+        cost, changes = self._chain_cost(head.tool, original_tools)
+        self.stats.cost_before += cost
+        self.stats.changes_before += changes
+        cost, changes = self._chain_cost(head_tool, [blocks[i].tool for i in order])
+        self.stats.cost_after += cost
+        self.stats.changes_after += changes
+
+        self._write_blocks([head] + [blocks[i] for i in order])
+        self._layer = []
+
+    def close(self):
+        self.finish_layer()
+
+
+def report(stats: LayerStats, lines_in: int, lines_out: int) -> str:
+    lines = ["KTC tool order optimization:",
+             "%d layers, %d reordered." % (stats.layers, stats.layers_reordered)]
+    for reason, count in sorted(stats.layers_skipped.items()):
+        lines.append("%d layers left unchanged: %s." % (count, reason))
+    lines.append("Toolchanges before: %d, after: %d." % (stats.changes_before,
+                                                      stats.changes_after))
+    lines.append("Toolchange cost before: %.1f, after: %.1f." % (stats.cost_before,
+                                                              stats.cost_after))
+    lines.append("Lines in: %d, lines out: %d." % (lines_in, lines_out))
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Reorder independent tool blocks in each layer to reduce toolchanges.")
+    parser.add_argument("input", help="G-code file to process.")
+    parser.add_argument("-o", "--output",
+                        help="Write to this file instead of changing the input in place.")
+    parser.add_argument("--costs", help="Cost table file with '<from> <to> <cost>' lines.")
+    parser.add_argument("--max-blocks", type=int, default=DEFAULT_MAX_BLOCKS,
+                        help="Don't reorder layers with more tool blocks. "
+                        "Default %(default)s.")
+    parser.add_argument("--margin", type=float, default=DEFAULT_MARGIN,
+                        help="mm around extrusion areas counted as overlapping. "
+                        "Default %(default)s.")
+    parser.add_argument("--max-layer-lines", type=int, default=DEFAULT_MAX_LAYER_LINES,
+                        help="Don't buffer layers longer than this. Default %(default)s.")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Only report, don't write anything.")
+    args = parser.parse_args(argv)
+
+    def optimize(out) -> ToolOrderOptimizer:
+        with open(args.input, encoding="utf-8", errors="surrogateescape") as f:
+            optimizer = ToolOrderOptimizer(out, CostTable(args.costs), args.max_blocks,
+                                           args.margin, args.max_layer_lines)
+            for line in f:
+                optimizer.feed(line)
+            optimizer.close()
+        if optimizer.lines_in + optimizer.lines_inserted != optimizer.lines_out:
+            raise RuntimeError("Line count changed from %d to %d."
+                               % (optimizer.lines_in, optimizer.lines_out))
+        return optimizer
+
+    if args.dry_run:
+        with open(os.devnull, "w", encoding="utf-8") as out:
+            optimizer = optimize(out)
+    else:
+        output = args.output or args.input
+        # Write to a temporary file and rename it so the input is never half written.
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(output)), suffix=".tmp")
+        try:
+            shutil.copymode(args.input, tmp_path)
+            with os.fdopen(fd, "w", encoding="utf-8", errors="surrogateescape") as out:
+                optimizer = optimize(out)
+            os.replace(tmp_path, output)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    print(report(optimizer.stats, optimizer.lines_in, optimizer.lines_out))
+
+if __name__ == "__main__":
+    main()
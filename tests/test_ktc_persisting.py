@@ -0,0 +1,128 @@
+# Tests for the journal of ktc_persisting. Run with: python -m pytest tests
+import importlib.util
+import os
+import time
+import types
+
+import pytest
+
+_PATH = os.path.join(os.path.dirname(__file__), "..", "extensions", "ktc_persisting.py")
+_spec = importlib.util.spec_from_file_location("ktc_persisting", _PATH)
+ktc_persisting = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(ktc_persisting)
+
+
+class _Log:
+    def debug(self, message):
+        pass
+
+    def always(self, message):
+        pass
+
+
+class _Reactor:
+    NEVER = 9999999999999999.
+
+    def monotonic(self):
+        return 0.
+
+    def register_timer(self, callback, waketime):
+        return None
+
+    def update_timer(self, timer, waketime):
+        pass
+
+
+class _Printer:
+    def __init__(self):
+        self.reactor = _Reactor()
+
+    def get_reactor(self):
+        return self.reactor
+
+    def load_object(self, config, name):
+        return _Log()
+
+    def register_event_handler(self, event, callback):
+        pass
+
+
+def _load(printer):
+    config = types.SimpleNamespace(get_printer=lambda: printer)
+    return ktc_persisting.KtcPersisting(config)
+
+
+def _loaded_content():
+    """Return the content a restart would load, stopping its writer thread."""
+    persisting = _load(_Printer())
+    persisting.disconnect()
+    return persisting.content
+
+
+@pytest.fixture
+def filename(tmp_path, monkeypatch):
+    path = str(tmp_path / "ktc_variables.cfg")
+    monkeypatch.setattr(ktc_persisting, "KTC_SAVE_VARIABLES_FILENAME", path)
+    return path
+
+
+def test_journal_is_replayed(filename):
+    persisting = _load(_Printer())
+    persisting.save_variable("a", "1", "State", force_save=True)
+    persisting.save_variable("b", "[1, 2]", "State", force_save=True)
+    persisting.disconnect()
+
+    assert _loaded_content() == {"State": {"a": 1, "b": [1, 2]}}
+
+
+def test_crash_between_snapshot_and_journal_truncate(filename, monkeypatch):
+    persisting = _load(_Printer())
+    persisting.save_variable("a", "1", "State", force_save=True)
+    # The next save compacts with a change not yet in the journal.
+    persisting.journal_size = ktc_persisting.KTC_SAVE_VARIABLES_JOURNAL_MAX_SIZE
+
+    def crash():
+        raise OSError("power loss")
+    monkeypatch.setattr(persisting, "_truncate_journal", crash)
+    persisting.save_variable("a", "2", "State", force_save=True)
+    persisting.disconnect()
+
+    assert persisting.write_errors == 1
+    # The old journal line for a is replayed over the new file.
+    assert _loaded_content() == {"State": {"a": 2}}
+
+
+def test_broken_last_journal_line_is_ignored(filename):
+    persisting = _load(_Printer())
+    persisting.save_variable("a", "1", "State", force_save=True)
+    persisting.disconnect()
+    with open(filename + ".journal", "a", encoding="utf-8") as f:
+        f.write("('State', 'a'")
+
+    persisting = _load(_Printer())
+    persisting.save_variable("b", "2", "State", force_save=True)
+    persisting.disconnect()
+    assert _loaded_content() == {"State": {"a": 1, "b": 2}}
+
+
+def test_failed_compaction_is_retried(filename, monkeypatch):
+    persisting = _load(_Printer())
+    persisting.save_variable("a", "1", "State", force_save=True)
+    persisting.journal_size = ktc_persisting.KTC_SAVE_VARIABLES_JOURNAL_MAX_SIZE
+
+    replace = os.replace
+    def fail(src, dst):
+        raise OSError("disk full")
+    monkeypatch.setattr(ktc_persisting.os, "replace", fail)
+    persisting.save_variable("a", "2", "State", force_save=True)
+    deadline = time.monotonic() + 5.
+    while persisting.write_errors == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert persisting.write_errors == 1
+
+    monkeypatch.setattr(ktc_persisting.os, "replace", replace)
+    persisting.force_save()
+    persisting.disconnect()
+
+    assert os.path.getsize(filename + ".journal") == 0
+    assert _loaded_content() == {"State": {"a": 2}}